@@ -0,0 +1,446 @@
+# End-to-end throughput benchmark for both forwarders.
+# Drives SEToDiscordForwarder and DiscordToSEForwarder against local stand-ins
+# for chat, the webhook and mongo, so it runs offline. Every fake endpoint has
+# a configurable latency, and the fake chat room can enforce a ratelimit the
+# same way the real one does (by failing with "again in N seconds").
+#
+#   python benchmarks/bridge.py [--messages N] [--chat-latency S] [--chat-rate R] ...
+#
+# --corpus takes a JSON lines file of recorded traffic instead of the synthetic
+# one: {"direction": "se", "content": "<html>", "user": 1, "reply": false, "kind": "send"} or
+# {"direction": "discord", "content": "markdown", "user": 1}. SE edits and
+# deletes ("kind": "edit"/"delete") apply to the latest message still around.
+from argparse import ArgumentParser
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+from itertools import count
+import json
+from random import Random
+from time import perf_counter
+import tracemalloc
+
+from pymongo import DeleteMany
+from sechat.errors import OperationFailedError
+from sechat.events import DeleteEvent, EditEvent, MessageEvent
+
+from bridget.conversion import ConversionPool
+from bridget.discord2se import DiscordToSEForwarder
+from bridget.records import BridgeRecords
+from bridget.scheduler import ChatScheduler, TokenBucket
+from bridget.se2discord import SEToDiscordForwarder
+from bridget.uploads import AttachmentUploader
+
+from chatifier import CORPUS as DISCORD_CORPUS, FakeGuild, FakeMember
+
+SE_CORPUS = [
+    "hi",
+    "good morning everyone",
+    "has anyone tried the new release yet?",
+    "yeah it's <b>way</b> faster than the old one",
+    "<i>technically</i> correct, the <strike>worst</strike> best kind of correct",
+    "<code>x = [i * 2 for i in range(10)]</code> is that idiomatic?",
+    "see <a href=\"https://codegolf.stackexchange.com/q/12345\">this question</a>",
+    "<div class='full'>line one<br>line two<br>line three</div>",
+    "<pre class='full'>def f(x):\n    return x + 1</pre>",
+    "<div class='full'><blockquote>quoted text</blockquote>and a response</div>",
+    "a" * 400,
+]
+
+ids = count(10 ** 9)
+
+
+def percentile(values: list[float], q: float):
+    if not len(values):
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def make_event(cls, **fields):
+    # sechat builds these from websocket frames, not keyword arguments
+    event = cls.__new__(cls)
+    for name, value in fields.items():
+        object.__setattr__(event, name, value)
+    return event
+
+
+def matches(document: dict, query: dict) -> bool:
+    # just enough of mongo's query language for what BridgeRecords asks
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, part) for part in condition):
+                return False
+        else:
+            if isinstance(condition, dict) and "$eq" in condition:
+                condition = condition["$eq"]
+            value = document.get(key)
+            if not (value == condition or (isinstance(value, list) and condition in value)):
+                return False
+    return True
+
+
+class FakeCollection:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.documents: dict[int, dict] = {}
+
+    async def bulk_write(self, operations, ordered: bool = True):
+        await asyncio.sleep(self.latency)
+        for operation in operations:
+            if isinstance(operation, DeleteMany):
+                for id in operation._filter["_id"]["$in"]:
+                    self.documents.pop(id, None)
+            else:
+                self.documents[operation._filter["_id"]] = operation._doc
+
+
+class FakeEngine:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.collection = FakeCollection(latency)
+        self.finds = 0
+
+    def get_collection(self, model):
+        return self.collection
+
+    async def find_one(self, model, query):
+        await asyncio.sleep(self.latency)
+        self.finds += 1
+        for document in self.collection.documents.values():
+            if matches(document, query):
+                return model.model_validate_doc(document)
+        return None
+
+
+class FakeChatRoom:
+    def __init__(self, room_id: int, latency: float, rate: float):
+        self.room_id = room_id
+        self.user_id = 1
+        self.latency = latency
+        self.rate = rate
+        self.sent = 0
+        self.throttled = 0
+        self._recent: deque[float] = deque()
+
+    def _check_ratelimit(self):
+        if not self.rate:
+            return
+        now = perf_counter()
+        while len(self._recent) and now - self._recent[0] > 1:
+            self._recent.popleft()
+        if len(self._recent) >= self.rate:
+            self.throttled += 1
+            raise OperationFailedError("You can perform this action again in 1 second")
+        self._recent.append(now)
+
+    async def send(self, content: str, reply_to: int | None = None):
+        await asyncio.sleep(self.latency)
+        self._check_ratelimit()
+        self.sent += 1
+        return next(ids)
+
+    async def edit(self, message_id: int, content: str):
+        await asyncio.sleep(self.latency)
+        self._check_ratelimit()
+
+    async def delete(self, message_id: int):
+        await asyncio.sleep(self.latency)
+        self._check_ratelimit()
+
+    async def upload_image(self, data, filename: str):
+        await asyncio.sleep(self.latency * 4)
+        return f"https://i.stack.imgur.com/{next(ids)}.png"
+
+    async def close(self):
+        pass
+
+
+class FakeUser:
+    def __init__(self, id: int):
+        self.id = id
+
+
+class FakeAuthor:
+    def __init__(self, id: int):
+        self.id = id
+        self.mention = f"<@{id}>"
+
+
+class FakeWebhookMessage:
+    def __init__(self, id: int, author_id: int):
+        self.id = id
+        self.author = FakeAuthor(author_id)
+        self.jump_url = f"https://discord.com/channels/1/2/{id}"
+
+
+class FakeWebhook:
+    def __init__(self, latency: float):
+        self.id = 42
+        self.user = FakeUser(42)
+        self.channel = None
+        self.guild_id = 1
+        self.channel_id = 2
+        self.latency = latency
+        self.sent = 0
+
+    async def send(self, content: str = "", wait: bool = False, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        return FakeWebhookMessage(next(ids), self.id)
+
+    async def fetch_message(self, id: int):
+        await asyncio.sleep(self.latency)
+        return FakeWebhookMessage(id, self.id)
+
+    async def edit_message(self, id: int, **kwargs):
+        await asyncio.sleep(self.latency)
+        return FakeWebhookMessage(id, self.id)
+
+    async def delete_message(self, id: int):
+        await asyncio.sleep(self.latency)
+
+
+class FakeHub:
+    def __init__(self, events: list, rate: float, started: dict[int, float]):
+        self.queued = events
+        self.rate = rate
+        self.started = started
+
+    async def events(self, room_id: int):
+        for event in self.queued:
+            if self.rate:
+                await asyncio.sleep(1 / self.rate)
+            self.started[id(event)] = perf_counter()
+            yield event
+
+
+class FakePFPFetcher:
+    async def fetch_pfp_url(self, user: int):
+        return f"https://example.com/{user}.png"
+
+
+class FakeHTTP:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def get_text(self, path: str):
+        await asyncio.sleep(self.latency)
+        return "some earlier message"
+
+
+class FakeChannel:
+    def __init__(self):
+        self.id = 2
+        self.guild = FakeGuild()
+        self.guild.id = 1 # type: ignore
+
+
+class FakeDiscordUser(FakeMember):
+    bot = False
+    roles = []
+
+
+class FakeDiscordMessage:
+    def __init__(self, content: str, author: FakeDiscordUser):
+        self.id = next(ids)
+        self.content = content
+        self.author = author
+        self.attachments = []
+        self.embeds = []
+        self.reactions = []
+        self.poll = None
+        self.reference = None
+        self.created_at = datetime.now(timezone.utc)
+
+    async def add_reaction(self, emoji: str):
+        pass
+
+
+class MeasuredSEToDiscord(SEToDiscordForwarder):
+    def __init__(self, *args, latencies: list[float], started: dict[int, float], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = latencies
+        self.started = started
+        self.skipped = 0
+
+    async def prepare_message(self, event):
+        if (prepared := await super().prepare_message(event)) is None:
+            self.skipped += 1
+        return prepared
+
+    async def deliver_message(self, event, *args):
+        await super().deliver_message(event, *args)
+        self.latencies.append(perf_counter() - self.started.pop(id(event)))
+
+    async def handle_delete(self, event):
+        await super().handle_delete(event)
+        self.latencies.append(perf_counter() - self.started.pop(id(event)))
+
+
+class MeasuredDiscordToSE(DiscordToSEForwarder):
+    def __init__(self, *args, latencies: list[float], started: dict[int, float], done: asyncio.Event, expected: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = latencies
+        self.started = started
+        self.done = done
+        self.expected = expected
+
+    def observe_sent(self, message):
+        super().observe_sent(message)
+        self.latencies.append(perf_counter() - self.started.pop(message.id))
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+
+def load_corpus(path: str | None, messages: int, seed: int):
+    random = Random(seed)
+    if path is not None:
+        with open(path) as file:
+            recorded = [json.loads(line) for line in file if line.strip()]
+        se = [entry for entry in recorded if entry["direction"] == "se"]
+        discord = [entry for entry in recorded if entry["direction"] == "discord"]
+        return se, discord
+    se = [
+        {
+            "content": random.choice(SE_CORPUS),
+            "user": random.randrange(20),
+            "reply": random.random() < 0.1,
+            "kind": random.choices(("send", "edit", "delete"), (0.8, 0.15, 0.05))[0],
+        }
+        for _ in range(messages)
+    ]
+    discord = [
+        {"content": random.choice(DISCORD_CORPUS), "user": random.randrange(20)}
+        for _ in range(messages)
+    ]
+    return se, discord
+
+
+def make_se_events(corpus: list[dict]):
+    # edits and deletes apply to the most recent message that's still around
+    events = []
+    live: list[int] = []
+    for entry in corpus:
+        kind = entry.get("kind", "send")
+        if kind == "delete" and len(live):
+            events.append(make_event(DeleteEvent, user_id=entry["user"], message_id=live.pop()))
+            continue
+        parent = live[-1] if entry.get("reply") and len(live) else None
+        if kind == "edit" and len(live):
+            message_id, cls = live[-1], EditEvent
+        else:
+            message_id, cls = next(ids), MessageEvent
+            live.append(message_id)
+        events.append(make_event(
+            cls,
+            content=entry["content"],
+            user_id=entry["user"],
+            user_name=f"user{entry['user']}",
+            message_id=message_id,
+            parent_id=parent,
+            show_parent=parent is not None,
+        ))
+    return events
+
+
+async def bench_se_to_discord(corpus: list[dict], args):
+    latencies: list[float] = []
+    started: dict[int, float] = {}
+    events = make_se_events(corpus)
+    records = BridgeRecords(FakeEngine(args.db_latency)) # type: ignore
+    forwarder = MeasuredSEToDiscord(
+        1, [], [], FakeWebhook(args.discord_latency), FakeHub(events, args.arrival_rate, started), records, FakeHTTP(args.chat_latency), FakePFPFetcher(), args.pipeline_depth, # type: ignore
+        latencies=latencies, started=started, conversions=ConversionPool(args.executor),
+    )
+    started_at = perf_counter()
+    async with asyncio.TaskGroup() as group:
+        flusher = group.create_task(records.run())
+        runner = group.create_task(forwarder.run())
+        # run() never returns on its own, since the deliver task loops forever
+        while len(latencies) + forwarder.skipped < len(events):
+            await asyncio.sleep(0.01)
+        elapsed = perf_counter() - started_at
+        runner.cancel()
+        flusher.cancel()
+    return elapsed, latencies
+
+
+async def bench_discord_to_se(corpus: list[dict], args):
+    latencies: list[float] = []
+    started: dict[int, float] = {}
+    done = asyncio.Event()
+    room = FakeChatRoom(1, args.chat_latency, args.chat_rate)
+    records = BridgeRecords(FakeEngine(args.db_latency)) # type: ignore
+    forwarder = MeasuredDiscordToSE(
+        room, records, FakeHTTP(args.chat_latency), AttachmentUploader(), FakeChannel(), 42, {}, [], # type: ignore
+        latencies=latencies, started=started, done=done, expected=len(corpus),
+    )
+    # the real limits start at 1/s; let the learned rate go as high as the fake room allows
+    forwarder.scheduler = ChatScheduler(TokenBucket(rate=args.chat_rate or 1e6, burst=args.chat_rate or 1e6, max_rate=args.chat_rate or 1e6))
+    # the typing relay needs a websocket, which this doesn't have
+    forwarder._typing_task = asyncio.Event().wait # type: ignore
+    authors = {}
+    started_at = perf_counter()
+    async with asyncio.TaskGroup() as group:
+        runner = group.create_task(forwarder.run())
+        flusher = group.create_task(records.run())
+        for entry in corpus:
+            author = authors.setdefault(entry["user"], FakeDiscordUser(entry["user"]))
+            message = FakeDiscordMessage(entry["content"], author)
+            started[message.id] = perf_counter()
+            await forwarder.queue_message(message) # type: ignore
+            if args.arrival_rate:
+                await asyncio.sleep(1 / args.arrival_rate)
+        await done.wait()
+        elapsed = perf_counter() - started_at
+        runner.cancel()
+        flusher.cancel()
+    return elapsed, latencies, room
+
+
+def report(name: str, sent: int, elapsed: float, latencies: list[float], peak: int):
+    print(
+        f"{name:>14}: {sent / elapsed:8.0f} msg/s  "
+        f"p50 {percentile(latencies, 0.5) * 1000:7.1f}ms  p99 {percentile(latencies, 0.99) * 1000:7.1f}ms  "
+        f"peak {peak / 1024 / 1024:6.1f} MiB"
+    )
+
+
+async def main(args):
+    se, discord = load_corpus(args.corpus, args.messages, args.seed)
+    # timing and allocation are measured in separate runs, since tracemalloc
+    # slows everything down a lot
+    if len(se):
+        elapsed, latencies = await bench_se_to_discord(se, args)
+        tracemalloc.start()
+        await bench_se_to_discord(se, args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report("SE → Discord", len(latencies), elapsed, latencies, peak)
+    if len(discord):
+        elapsed, latencies, room = await bench_discord_to_se(discord, args)
+        tracemalloc.start()
+        await bench_discord_to_se(discord, args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report("Discord → SE", len(latencies), elapsed, latencies, peak)
+        print(f"{'':>14}  {room.sent} chat messages for {len(discord)} Discord messages, throttled {room.throttled} times")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark both bridge directions against fake chat, Discord and mongo")
+    parser.add_argument("--messages", type=int, default=2000, help="size of the synthetic corpus, per direction")
+    parser.add_argument("--corpus", help="JSON lines file of recorded messages to replay instead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--arrival-rate", type=float, default=0, help="messages per second fed in; 0 means as fast as possible")
+    parser.add_argument("--chat-latency", type=float, default=0.005, help="seconds per chat request")
+    parser.add_argument("--chat-rate", type=float, default=0, help="chat's ratelimit in messages per second; 0 means none")
+    parser.add_argument("--discord-latency", type=float, default=0.005, help="seconds per webhook request")
+    parser.add_argument("--db-latency", type=float, default=0.001, help="seconds per database call")
+    parser.add_argument("--pipeline-depth", type=int, default=8)
+    parser.add_argument("--executor", choices=("inline", "thread", "process"), default="inline", help="where SE HTML conversion runs")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,201 @@
+# Micro-benchmark for Chatifier.convert.
+# Runs a corpus of typical Discord messages through the current renderer and
+# through the old nested-async-generator one, checks they agree, and reports
+# throughput and peak allocation for both.
+#
+#   python benchmarks/chatifier.py [--rounds N]
+from argparse import ArgumentParser
+import asyncio
+from itertools import chain
+from time import perf_counter
+import tracemalloc
+from typing import Optional
+
+from discord_markdown_ast_parser import parse
+from discord_markdown_ast_parser.parser import Node, NodeType
+
+from bridget.chatifier import Chatifier
+
+CORPUS = [
+    "hi",
+    "lol",
+    "good morning everyone",
+    "has anyone tried the new release yet?",
+    "yeah it's **way** faster than the old one",
+    "<@180004315373944833> did you see this",
+    "<@180004315373944833> <@223878524281749504> can one of you review my PR",
+    "check <#1011214578497617940> for the announcement",
+    "<@&998276823151456256> meeting in 5",
+    "`x = [i * 2 for i in range(10)]` is that idiomatic?",
+    "that's *technically* correct, the ~~worst~~ best kind of correct",
+    "||the butler did it||",
+    "__underlined__ and ***bold italic*** text",
+    "https://codegolf.stackexchange.com/questions/12345/shortest-quine",
+    "<https://example.com/no-preview>",
+    "nice <:pepeclap:834534523452345345> <:thonk:234523452345234523>",
+    "> quoted line one\n> quoted line two",
+    "> someone said this\nand I disagree",
+    "```py\ndef f(x):\n    return x + 1\n```",
+    "```\nplain code block\nwith two lines\n```",
+    "line one\nline two\nline three",
+    "mixed **bold with <@180004315373944833> inside** and `code` and a https://example.com link",
+    "a" * 400,
+    "*" * 20 + " stars " + "_" * 20,
+]
+
+class FakeMember:
+    def __init__(self, id: int):
+        self.id = id
+        self.display_name = f"member{id % 1000}"
+
+class FakeChannel:
+    def __init__(self, id: int):
+        self.id = id
+        self.name = f"channel-{id % 1000}"
+
+class FakeRole:
+    def __init__(self, id: int):
+        self.id = id
+        self.name = f"role-{id % 1000}"
+
+class FakeGuild:
+    # everything is in the gateway cache, so this measures conversion only
+    def get_member(self, id: int):
+        return FakeMember(id)
+
+    def get_channel_or_thread(self, id: int):
+        return FakeChannel(id)
+
+    def get_role(self, id: int):
+        return FakeRole(id)
+
+    async def fetch_member(self, id: int):
+        return FakeMember(id)
+
+    async def fetch_channel(self, id: int):
+        return FakeChannel(id)
+
+    async def query_members(self, user_ids: list[int], limit: int):
+        return [FakeMember(id) for id in user_ids]
+
+class GeneratorChatifier:
+    # the previous implementation, kept as the baseline
+    def __init__(self, guild):
+        self.guild = guild
+
+    async def convert_children(self, node: Node):
+        if node.children is None:
+            return
+        for child in node.children:
+            async for string in self.convert_node(child):
+                yield string
+    async def wrap(self, node: Node, start: str, end: Optional[str] = None):
+        yield start
+        async for string in self.convert_children(node):
+            yield string
+        yield end if end is not None else start
+
+    async def convert_node(self, node: Node):
+        match node.node_type:
+            case NodeType.TEXT:
+                yield node.text_content
+            case NodeType.ITALIC | NodeType.BOLD | NodeType.UNDERLINE:
+                async for string in self.wrap(node, "_"):
+                    yield string
+            case NodeType.STRIKETHROUGH:
+                async for string in self.wrap(node, "---"):
+                    yield string
+            case NodeType.SPOILER:
+                async for string in self.wrap(node, "[spoiler](https://spoiler \"", "\")"):
+                    yield string
+            case NodeType.CODE_INLINE:
+                async for string in self.wrap(node, "`"):
+                    yield string
+            case NodeType.USER:
+                member = await self.guild.fetch_member(node.discord_id)
+                yield f"@!{member.display_name}"
+            case NodeType.ROLE:
+                yield f"@!{self.guild.get_role(node.discord_id).name}"
+            case NodeType.CHANNEL:
+                channel = await self.guild.fetch_channel(node.discord_id)
+                yield f"#{channel.name}"
+            case NodeType.EMOJI_CUSTOM | NodeType.EMOJI_UNICODE_ENCODED:
+                yield f":{node.emoji_name}:"
+            case NodeType.URL_WITH_PREVIEW | NodeType.URL_WITHOUT_PREVIEW:
+                yield node.url
+            case NodeType.QUOTE_BLOCK:
+                for line in "".join([i async for i in self.convert_children(node)]).splitlines(True):
+                    yield f"> {line}"
+            case NodeType.CODE_BLOCK:
+                for line in "".join([i async for i in self.convert_children(node)]).splitlines(True):
+                    yield f"    {line}"
+
+    async def convert(self, message: str):
+        nodes = parse(message)
+        if len(nodes) == 1 and nodes[0].node_type in (NodeType.QUOTE_BLOCK, NodeType.CODE_BLOCK):
+            return "".join([i async for i in self.convert_node(nodes[0])])
+        else:
+            return "".join(chain(*[[i async for i in self.convert_node(node)] for node in nodes])).strip("\n")
+
+async def run_corpus(converter, rounds: int):
+    for _ in range(rounds):
+        for message in CORPUS:
+            await converter.convert(message)
+
+async def render_generators(converter: GeneratorChatifier, parsed: list[list[Node]], rounds: int):
+    for _ in range(rounds):
+        for nodes in parsed:
+            "".join(chain(*[[i async for i in converter.convert_node(node)] for node in nodes]))
+
+async def render_flat(converter: Chatifier, parsed: list[list[Node]], rounds: int):
+    for _ in range(rounds):
+        for nodes in parsed:
+            await converter.resolve_mentions(nodes)
+            output: list[str] = []
+            for node in nodes:
+                converter.render_node(node, output)
+            "".join(output)
+
+async def measure(converter, rounds: int):
+    # timing and allocation are measured in separate runs, since tracemalloc
+    # slows everything down a lot
+    started_at = perf_counter()
+    await run_corpus(converter, rounds)
+    elapsed = perf_counter() - started_at
+    tracemalloc.start()
+    await run_corpus(converter, 1)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+async def main(rounds: int):
+    guild = FakeGuild()
+    current = Chatifier(guild) # type: ignore
+    baseline = GeneratorChatifier(guild)
+    for message in CORPUS:
+        expected, got = await baseline.convert(message), await current.convert(message)
+        if expected != got:
+            raise SystemExit(f"output mismatch for {message!r}:\n  expected {expected!r}\n  got      {got!r}")
+
+    total = rounds * len(CORPUS)
+    results = {}
+    for name, converter in (("generators", baseline), ("flat", current)):
+        elapsed, peak = await measure(converter, rounds)
+        results[name] = elapsed
+        print(f"{name:>10}: {total / elapsed:9.0f} msg/s  {elapsed / total * 1e6:7.1f} us/msg  peak {peak / 1024:7.1f} KiB")
+    print(f"   speedup: {results['generators'] / results['flat']:.2f}x (including markdown parsing)")
+
+    # the parser is shared and dominates the above, so also time rendering on its own
+    parsed = [parse(message) for message in CORPUS]
+    started_at = perf_counter()
+    await render_generators(baseline, parsed, rounds)
+    generators = perf_counter() - started_at
+    started_at = perf_counter()
+    await render_flat(current, parsed, rounds)
+    flat = perf_counter() - started_at
+    print(f"rendering only: generators {generators / total * 1e6:.1f} us/msg, flat {flat / total * 1e6:.1f} us/msg, speedup {generators / flat:.2f}x")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark Chatifier.convert")
+    parser.add_argument("--rounds", type=int, default=200)
+    asyncio.run(main(parser.parse_args().rounds))
@@ -0,0 +1,110 @@
+# Differential check for Discordifier's fast path.
+# Runs a corpus of typical chat messages, plus randomly generated inline HTML,
+# through both convert_fast and the soup-based convert_full, and fails on the
+# first input where the fast path gives a different answer. Then reports how
+# much of the corpus takes the fast path and how much quicker it is.
+#
+#   python benchmarks/discordifier.py [--cases N] [--seed N] [--rounds N]
+from argparse import ArgumentParser
+import random
+from time import perf_counter
+import warnings
+
+from bs4 import MarkupResemblesLocatorWarning
+
+from bridget.discordifier import Discordifier
+
+CORPUS = [
+    "hi",
+    "good morning everyone",
+    "has anyone tried the new release yet?",
+    "yeah it&#39;s <b>way</b> faster than the old one",
+    "that&#39;s <i>technically</i> correct, the <strike>worst</strike> best kind of correct",
+    "<code>x = [i * 2 for i in range(10)]</code> is that idiomatic?",
+    "<code>a_b *c* `d`</code>",
+    "@Someone did you see this",
+    "see <a href=\"//codegolf.stackexchange.com/q/12345\">this question</a>",
+    "<a href=\"/users/12345/someone\">someone</a> said so",
+    "<a href=\"https://example.com?x=1&amp;y=2\" rel=\"nofollow noopener noreferrer\">https://example.com?x=1&amp;y=2</a>",
+    "<a href=\"https://spoiler\" title=\"the butler did it\">spoiler</a>",
+    "<b><i>bold italic</i></b> and <i>_underscores_</i>",
+    "1 &lt; 2 &amp;&amp; 3 &gt; 2",
+    "snake_case and *stars* and ~tildes~",
+    "   leading whitespace",
+    "trailing whitespace   ",
+    "ü 😀 &quot;quoted&quot;",
+    # these all have to take the full path
+    "<div class=\"full\">line one<br>line two</div>",
+    "<div class=\"partial\">a long<br>message</div>",
+    "<pre class=\"full\">code block</pre>",
+    "<div class=\"onebox ob-image\"><a rel=\"nofollow noopener noreferrer\" href=\"//i.sstatic.net/abc.png\"><img src=\"//i.sstatic.net/abc.png\" class=\"user-image\" alt=\"user image\"></a></div>",
+    "<span class=\"mention\">@someone</span> hi",
+    "&nbsp;&nbsp;spaced",
+    "unclosed <b>bold",
+]
+
+ATOMS = [
+    "hello", " ", "  ", "\t", "*", "_", "`", "``", "a_b", "**", "&amp;", "&lt;", "&gt;", "&quot;", "&#39;",
+    "&nbsp;", "\xa0", "x", "http://a.com", "@user", "||", "~", ">", "\\", "[", "]", "(", ")", "#", "1.", "-",
+    "spoiler", "ü", "😀", "&", "&foo;", "<", "\"",
+]
+
+def generate(rng: random.Random, depth: int = 0) -> str:
+    # inline markup nested a few levels deep, with everything that needs escaping
+    output = []
+    for _ in range(rng.randint(0, 5)):
+        if rng.random() < 0.6 or depth > 2:
+            output.append(rng.choice(ATOMS))
+            continue
+        tag = rng.choice(["b", "i", "code", "a", "a", "s", "strike", "span"])
+        inner = generate(rng, depth + 1)
+        if tag == "a":
+            href = rng.choice(["http://a.com", "//x.com/a_b", "/users/1", "https://spoiler", "http://a.com?x=1&amp;y=2", inner if "<" not in inner else "http://q"])
+            title = rng.choice(["", " title=\"secret\"", " title=\"a &quot;q&quot;\""])
+            rel = rng.choice(["", " rel=\"nofollow\""])
+            output.append(f"<a href=\"{href}\"{title}{rel}>{inner}</a>")
+        else:
+            output.append(f"<{tag}>{inner}</{tag}>")
+    return "".join(output)
+
+def check(converter: Discordifier, content: str):
+    if (nodes := converter.parse_fast(content)) is None:
+        return False
+    fast = converter.render_fast(nodes, {"body"})
+    full = converter.convert_full(content)
+    if fast != full:
+        raise SystemExit(f"output mismatch for {content!r}:\n  full {full!r}\n  fast {fast!r}")
+    return True
+
+def main(cases: int, seed: int, rounds: int):
+    # some generated inputs are just a url, which bs4 complains about
+    warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)
+    converter = Discordifier()
+    rng = random.Random(seed)
+    generated = [content for content in (generate(rng) for _ in range(cases)) if content]
+    fast = sum(check(converter, content) for content in CORPUS)
+    print(f"    corpus: {fast}/{len(CORPUS)} on the fast path, all matching")
+    fast = sum(check(converter, content) for content in generated)
+    print(f" generated: {fast}/{len(generated)} on the fast path, all matching")
+
+    total = rounds * len(CORPUS)
+    started_at = perf_counter()
+    for _ in range(rounds):
+        for content in CORPUS:
+            converter.convert_full(content)
+    full = perf_counter() - started_at
+    started_at = perf_counter()
+    for _ in range(rounds):
+        for content in CORPUS:
+            converter.convert_html(content)
+    mixed = perf_counter() - started_at
+    print(f"  full only: {full / total * 1e6:7.1f} us/msg")
+    print(f"  with fast: {mixed / total * 1e6:7.1f} us/msg, speedup {full / mixed:.2f}x")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Check Discordifier's fast path against the full converter")
+    parser.add_argument("--cases", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+    main(args.cases, args.seed, args.rounds)
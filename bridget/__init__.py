@@ -1,36 +1,57 @@
-from asyncio import TaskGroup
+from asyncio import Lock, Semaphore, Task, TaskGroup, create_task, gather, get_running_loop
+from contextlib import AsyncExitStack
 from datetime import datetime
-import html
+from functools import partial
 import json
+from os import getpid
+import signal
+from socket import gethostname
+from time import monotonic
+from typing import Awaitable, Callable
 from logging import getLogger
 
-from aiohttp import ClientSession
-from bs4 import BeautifulSoup, Tag
-from discord import AllowedMentions, Client, Color, Embed, Intents, Interaction, Member, Message, TextChannel, User, Webhook
-from discord.abc import Messageable
+from discord import AllowedMentions, Client, Color, Embed, Guild, Intents, Interaction, Member, Message, NotFound, Permissions, TextChannel, User, Webhook
+from discord.abc import GuildChannel, Messageable
 from discord.app_commands import CommandTree, Command, ContextMenu, Group
 from discord.utils import find, MISSING
 from odmantic import AIOEngine
 from sechat import Credentials, Room
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from bridget.conversion import ConversionPool
 from bridget.discord2se import DiscordToSEForwarder
-from bridget.discordifier import Discordifier
-from bridget.models import BridgedMessage, Configuration, DualBridge, SingleBridge
+from bridget.http import ChatHTTP
+from bridget.hub import RoomHub
+from bridget.journal import Journal, open_journal
+from bridget import metrics
+from bridget.models import CachedWebhook, Configuration, DualBridge, SingleBridge
+from bridget.records import BridgeRecords
+from bridget.retention import migrate, run_retention
+from bridget.scheduler import Priority
 from bridget.se2discord import SEToDiscordForwarder
-from bridget.util import pretty_delta, resolve_chat_pfp
+from bridget.sharding import LeaseCoordinator, dual_key, single_key
+from bridget.uploads import AttachmentUploader
+from bridget.util import ChatPFPFetcher, ChatProfileFetcher, UNKNOWN_WEBHOOK, fix_chat_url, pretty_delta, resolve_chat_pfp, webhook_payload
 
 class BridgetClient(Client):
-    def __init__(self, config: Configuration):
+    # bridge settings that can change without reconnecting anything
+    hot_fields = ("ignore", "roleIcons", "noembed")
+
+    def __init__(self, config: Configuration, config_path: str = "config.json"):
         intents = Intents.none()
         intents.guilds = True
         intents.guild_messages = True
         intents.guild_typing = True
         intents.message_content = True
         intents.messages = True
-        super().__init__(intents=intents)
+        sharding = config.get("sharding", {})
+        if "shardCount" in sharding:
+            super().__init__(intents=intents, shard_id=sharding.get("firstShard", 0), shard_count=sharding["shardCount"])
+        else:
+            super().__init__(intents=intents)
 
         self.config = config
+        self.config_path = config_path
         self.logger = getLogger("DiscordClient")
         self.tree = CommandTree(self)
         self.allowed_mentions = AllowedMentions(everyone=False, users=True, roles=False, replied_user=True)
@@ -65,15 +86,37 @@ class BridgetClient(Client):
             callback=self.user_list
         ))
         self.tree.add_command(room_group)
+        reload_command = Command(
+            name="reload",
+            description="Reload the bridge configuration (bot owner only)",
+            callback=self.reload_command
+        )
+        reload_command.default_permissions = Permissions(administrator=True)
+        self.tree.add_command(reload_command)
 
         self.se_forwarders: dict[Messageable, DiscordToSEForwarder] = {}
+        self.chat_http = ChatHTTP()
+        self.room_hub = RoomHub()
+        self.journal: Journal | None = None
+        self.uploader = AttachmentUploader()
+        self.conversions = ConversionPool.from_config(self.config.get("conversion"))
+        # bounds the REST calls and room joins made while bridges start up
+        self.startup_slots = Semaphore(self.config.get("startupConcurrency", 4))
+        self.profile_fetcher = ChatProfileFetcher(self.chat_http)
+        self.pfp_fetcher = ChatPFPFetcher(self.profile_fetcher, self.config.get("pfpCache"))
         self.ignore = {forwarder["channel"]: set(forwarder["ignore"]) for forwarder in self.config["dual"]}
+        # what's running, by bridge key, so a reload can tell what to touch
+        self.bridge_tasks: dict[str, Task[None]] = {}
+        self.room_forwarders: dict[str, SEToDiscordForwarder] = {}
+        self.coordinator: LeaseCoordinator | None = None
+        self.bridge_group: TaskGroup | None = None
+        self._reload_lock = Lock()
 
     async def setup_hook(self):
         await self.tree.sync()
 
     def should_forward(self, message: Message):
-        return message.channel in self.se_forwarders and message.author.discriminator != "0000" and message.author.id not in self.ignore[message.channel.id]
+        return message.channel in self.se_forwarders and message.author.discriminator != "0000" and message.author.id not in self.ignore.get(message.channel.id, ())
 
     async def on_message(self, message: Message):
         if self.should_forward(message):
@@ -91,16 +134,43 @@ class BridgetClient(Client):
         if channel in self.se_forwarders and isinstance(user, Member):
             await self.se_forwarders[channel].queue_typing(user)
 
+    def forwarders_in(self, guild: Guild):
+        return [forwarder for forwarder in self.se_forwarders.values() if forwarder.channel.guild == guild]
+
+    # member events need the privileged members intent, which we don't ask for,
+    # so member names only expire by TTL. channel events come with guilds
+    async def on_guild_channel_update(self, before: GuildChannel, after: GuildChannel):
+        for forwarder in self.forwarders_in(after.guild):
+            forwarder.converter.invalidate_channel(after.id)
+
+    async def on_guild_channel_delete(self, channel: GuildChannel):
+        for forwarder in self.forwarders_in(channel.guild):
+            forwarder.converter.invalidate_channel(channel.id)
+
     async def check_queued(self, interaction: Interaction):
         if interaction.channel is not None and interaction.channel in self.se_forwarders:
             forwarder = self.se_forwarders[interaction.channel]
+            scheduler = forwarder.scheduler
             await interaction.response.send_message(embed=Embed(
                 color=Color.brand_green(),
                 title="Queue status",
                 description="\n".join((
-                    f"{forwarder._send_queue.qsize()} messages to send",
-                    f"{forwarder._edit_queue.qsize()} messages to edit",
-                    f"{forwarder._delete_queue.qsize()} messages to delete",
+                    *(
+                        f"{scheduler.depth(priority)} {priority.name.lower()} jobs queued (oldest {scheduler.oldest_age(priority):.1f}s, average wait {scheduler.average_wait(priority):.1f}s)"
+                        for priority in Priority
+                    ),
+                    f"Chat ratelimit: {scheduler.bucket.rate:.2f}/s, throttled {scheduler.bucket.throttles} times, {sum(scheduler.failed.values())} jobs failed",
+                    f"Record cache: {forwarder.records.hits} hits, {forwarder.records.misses} misses, {forwarder.records.pending} writes pending",
+                    f"Attachments: {self.uploader.uploads} uploaded, {self.uploader.by_attachment.hits + self.uploader.by_hash.hits} reused",
+                    f"Chat HTTP: {self.chat_http.requests} requests, {self.chat_http.failures} failed, {self.chat_http.average_latency * 1000:.0f}ms average",
+                    f"Discord → chat: p50 {metrics.discord_to_se_latency.quantile(0.5, channel=forwarder.channel.id):.2f}s, p99 {metrics.discord_to_se_latency.quantile(0.99, channel=forwarder.channel.id):.2f}s",
+                    *(
+                        f"Chat → Discord {kind}s: p50 {metrics.se_to_discord_latency.quantile(0.5, room=forwarder.room.room_id, kind=kind):.2f}s, p99 {metrics.se_to_discord_latency.quantile(0.99, room=forwarder.room.room_id, kind=kind):.2f}s"
+                        for kind in ("send", "edit", "delete")
+                        if metrics.se_to_discord_latency.count(room=forwarder.room.room_id, kind=kind)
+                    ),
+                    f"Conversion: {metrics.conversion_time.average(direction='discord_to_se', path='full') * 1000:.2f}ms to chat, {metrics.conversion_time.average(direction='se_to_discord', path='fast') * 1000:.2f}ms/{metrics.conversion_time.average(direction='se_to_discord', path='full') * 1000:.2f}ms (fast/full) to Discord",
+                    f"Database: {metrics.mongo_latency.average(operation='find') * 1000:.1f}ms per lookup, {metrics.mongo_latency.average(operation='bulk_write') * 1000:.1f}ms per flush",
                 )),
             ), ephemeral=True)
         else:
@@ -117,16 +187,11 @@ class BridgetClient(Client):
     async def room_info(self, interaction: Interaction):
         if interaction.channel is not None and interaction.channel in self.se_forwarders:
             forwarder = self.se_forwarders[interaction.channel]
-            async with ClientSession() as session:
-                async with session.get(f"https://chat.stackexchange.com/rooms/thumbs/{forwarder.room.room_id}") as response:
-                    room_info = await response.json()
-                async with session.get(f"https://chat.stackexchange.com/rooms/{forwarder.room.room_id}") as response:
-                    soup = BeautifulSoup(await response.content.read(), features="lxml")
-                    assert isinstance(userDiv := soup.find(class_="js-present"), Tag)
-                    users = json.loads(html.unescape(userDiv.attrs["data-users"]))
+            room_info = await self.chat_http.get_json(f"/rooms/thumbs/{forwarder.room.room_id}")
+            users = await self.conversions.parse_room_users(await self.chat_http.get_bytes(f"/rooms/{forwarder.room.room_id}"))
             await interaction.response.send_message(embed=Embed(
                 title=room_info["name"],
-                description=SEToDiscordForwarder.converter.convert(BeautifulSoup(room_info["description"], features="lxml")),
+                description=await self.conversions.convert_description(room_info["description"]),
                 url=f"https://chat.stackexchange.com/rooms/{forwarder.room.room_id}",
             ).add_field(
                 name="In room", value=", ".join(
@@ -151,80 +216,327 @@ class BridgetClient(Client):
             url=resolve_chat_pfp(user["email_hash"])
         ).set_footer(
             text=user["site"]["caption"],
-            icon_url=Discordifier.fix_url(user["site"]["icon"])
+            icon_url=fix_chat_url(user["site"]["icon"])
         )
 
     async def user_list(self, interaction: Interaction):
         if interaction.channel is not None and interaction.channel in self.se_forwarders:
             await interaction.response.defer(ephemeral=True, thinking=True)
             forwarder = self.se_forwarders[interaction.channel]
-            async with ClientSession() as session:
-                async with session.get(f"https://chat.stackexchange.com/rooms/{forwarder.room.room_id}") as response:
-                    soup = BeautifulSoup(await response.content.read(), features="lxml")
-                    assert isinstance(user_list := soup.find(class_="js-present"), Tag)
-                    users = json.loads(html.unescape(user_list.attrs["data-users"]))
+            users = await self.conversions.parse_room_users(await self.chat_http.get_bytes(f"/rooms/{forwarder.room.room_id}"))
 
+            # fetch everyone at once (bounded by the profile fetcher), and send
+            # each page of embeds as soon as its users have been fetched
+            fetches = [create_task(self.profile_fetcher.fetch_profile(partial["id"])) for partial in users]
+            if not len(fetches):
+                await interaction.followup.send("Nobody is in the room.", ephemeral=True)
+            sent = 0
+            for page in range(0, len(fetches), 10):
                 embeds = []
-                for partial in users:
-                    async with session.get(f"https://chat.stackexchange.com/users/thumbs/{partial['id']}") as response:
-                        user = await response.json()
-                    embeds.append(
-                        self.make_user_embed(user)
-                    )
-            await interaction.followup.send(embeds=embeds, ephemeral=True)
+                for user in await gather(*fetches[page:page + 10], return_exceptions=True):
+                    if isinstance(user, BaseException):
+                        self.logger.warning(f"Failed to fetch user for user list: {user!r}")
+                    else:
+                        embeds.append(self.make_user_embed(user))
+                if len(embeds):
+                    await interaction.followup.send(embeds=embeds, ephemeral=True)
+                    sent += len(embeds)
+            if len(fetches) and not sent:
+                # otherwise the deferred response just sits there thinking
+                await interaction.followup.send("Couldn't fetch anyone in the room, try again later.", ephemeral=True)
         else:
             await interaction.response.send_message(content="This channel is not bridged.", ephemeral=True)
 
     async def user_info(self, interaction: Interaction, message: Message):
         if message.channel in self.se_forwarders:
             forwarder = self.se_forwarders[message.channel]
-            if (bridge_record := await forwarder.engine.find_one(BridgedMessage, BridgedMessage.discord_message_id == message.id)) is not None:
-                async with ClientSession() as session, session.get(f"https://chat.stackexchange.com/users/thumbs/{bridge_record.se_user_id}") as response:
-                    user = await response.json()
+            if (bridge_record := await forwarder.records.by_discord_id(message.id)) is not None:
+                if bridge_record.se_user_id is None:
+                    await interaction.response.send_message("This message is too old to look up its author.", ephemeral=True)
+                    return
+                user = await self.profile_fetcher.fetch_profile(bridge_record.se_user_id)
                 await interaction.response.send_message(embed=self.make_user_embed(user), ephemeral=True)
             else:
                 await interaction.response.send_message("This message was not bridged.", ephemeral=True)
         else:
             await interaction.response.send_message(content="This channel is not bridged.", ephemeral=True)
 
-    async def run_one_way(self, config: SingleBridge, engine: AIOEngine, credentials: Credentials):
-        webhook = await Webhook.from_url(config["hook"], client=self).fetch()
-        assert webhook.channel is not None
-        forwarder = SEToDiscordForwarder(config["room"], [credentials.user_id], config["noembed"], webhook, engine)
-        async with TaskGroup() as group:
-            group.create_task(forwarder.run())
-            self.logger.info(f"Started one-way forwarder from room {config['room']} to channel {webhook.channel.name} in guild {webhook.channel.guild.name}")
+    async def cached_webhook(self, key: str):
+        if (cached := await self.engine.find_one(CachedWebhook, CachedWebhook.key == key)) is None:
+            return None
+        return cached.payload
+
+    async def cache_webhook(self, key: str, webhook: Webhook):
+        await self.engine.save(CachedWebhook(key=key, payload=webhook_payload(webhook)))
+
+    async def forget_webhook(self, key: str):
+        await self.engine.remove(CachedWebhook, CachedWebhook.key == key)
 
-    async def run_two_way(self, config: DualBridge, engine: AIOEngine, credentials: Credentials):
-        channel = await self.fetch_channel(config["channel"])
+    async def resolve_one_way(self, config: SingleBridge):
+        key = single_key(config)
+        # the token comes from the url, so only the rest is cached
+        partial_webhook = Webhook.from_url(config["hook"], client=self)
+        if (payload := await self.cached_webhook(key)) is not None:
+            webhook = Webhook.from_state(payload | {"token": partial_webhook.token}, self._connection) # type: ignore
+            # only the webhook token is needed to send, same as Webhook.from_url
+            webhook.auth_token = None
+            return webhook
+        async with self.startup_slots:
+            webhook = await partial_webhook.fetch()
+        await self.cache_webhook(key, webhook)
+        return webhook
+
+    async def resolve_two_way(self, config: DualBridge):
+        await self.wait_until_ready()
+        assert self.user is not None
+        key = dual_key(config)
+        if (channel := self.get_channel(config["channel"])) is None:
+            async with self.startup_slots:
+                channel = await self.fetch_channel(config["channel"])
         assert isinstance(channel, TextChannel)
+        async with self.startup_slots:
+            if (payload := await self.cached_webhook(key)) is not None:
+                # we own it, so fetching it by id gets us the token without listing the channel's webhooks
+                try:
+                    return channel, await self.fetch_webhook(payload["id"])
+                except NotFound:
+                    await self.forget_webhook(key)
+            if not isinstance(webhook := find(lambda webhook: webhook.user == self.user, await channel.webhooks()), Webhook):
+                webhook = await channel.create_webhook(name="Bridget", reason="Creating bridge webhook")
+        await self.cache_webhook(key, webhook)
+        return channel, webhook
+
+    def webhook_gone(self, errors: BaseExceptionGroup):
+        # as opposed to anything else that wasn't found, like a message that got deleted
+        return errors.subgroup(lambda e: isinstance(e, NotFound) and e.code == UNKNOWN_WEBHOOK) is not None
+
+    async def join_room(self, stack: AsyncExitStack, credentials: Credentials, room_id: int):
+        async with self.startup_slots:
+            return await stack.enter_async_context(Room.join(credentials, room_id))
+
+    async def run_one_way(self, config: SingleBridge, records: BridgeRecords, credentials: Credentials):
+        webhook = await self.resolve_one_way(config)
+        await self.wait_until_ready()
+        forwarder = SEToDiscordForwarder(config["room"], [credentials.user_id], config["noembed"], webhook, self.room_hub, records, self.chat_http, self.pfp_fetcher, self.config.get("pipelineDepth", 8), conversions=self.conversions)
+        self.room_forwarders[single_key(config)] = forwarder
+        metrics.queue_depth.track(forwarder._pipeline.qsize, queue="pipeline", room=config["room"])
+        try:
+            async with TaskGroup() as group:
+                group.create_task(forwarder.run())
+                self.logger.info(f"Started one-way forwarder from room {config['room']} to channel {webhook.channel_id} in guild {webhook.guild_id} after {monotonic() - self.started_at:.1f}s")
+        except* NotFound as errors:
+            if self.webhook_gone(errors):
+                # resolve it again next time
+                await self.forget_webhook(single_key(config))
+            raise
+        finally:
+            self.room_forwarders.pop(single_key(config), None)
+            metrics.queue_depth.untrack(queue="pipeline", room=config["room"])
+
+    async def run_two_way(self, config: DualBridge, records: BridgeRecords, credentials: Credentials):
         assert self.user is not None
-        if not isinstance(webhook := find(lambda webhook: webhook.user == self.user, await channel.webhooks()), Webhook):
-            webhook = await channel.create_webhook(name="Bridget", reason="Creating bridge webhook")
-        
-        async with Room.join(credentials, config["room"]) as room:
-            se_to_discord = SEToDiscordForwarder(room.room_id, [credentials.user_id], config.get("noembed", []), webhook, engine)
-            discord_to_se = DiscordToSEForwarder(room, engine, channel, self.user.id, config["roleIcons"], config["ignore"])
+        async with AsyncExitStack() as stack:
+            # chat doesn't need the gateway, so join while discord is still connecting
+            room, (channel, webhook) = await gather(self.join_room(stack, credentials, config["room"]), self.resolve_two_way(config))
+            # the hub's connection for this room keeps us in the room list
+            self.room_hub.attach(room)
+            se_to_discord = SEToDiscordForwarder(room.room_id, [credentials.user_id], config.get("noembed", []), webhook, self.room_hub, records, self.chat_http, self.pfp_fetcher, self.config.get("pipelineDepth", 8), conversions=self.conversions)
+            discord_to_se = DiscordToSEForwarder(room, records, self.chat_http, self.uploader, channel, self.user.id, config["roleIcons"], config["ignore"], self.journal)
+            if replayed := await discord_to_se.replay():
+                self.logger.info(f"Replayed {replayed} journaled operations for channel {channel.name}")
             self.se_forwarders[channel] = discord_to_se
-            async with TaskGroup() as group:
-                group.create_task(se_to_discord.run())
-                group.create_task(discord_to_se.run())
-                self.logger.info(f"Started two-way forwarder between room {room.room_id} and channel {channel.name} in guild {channel.guild.name}")
+            self.room_forwarders[dual_key(config)] = se_to_discord
+            metrics.queue_depth.track(se_to_discord._pipeline.qsize, queue="pipeline", room=room.room_id)
+            for priority in Priority:
+                metrics.queue_depth.track(partial(discord_to_se.scheduler.depth, priority), queue=priority.name.lower(), channel=channel.id)
+                metrics.queue_age.track(partial(discord_to_se.scheduler.oldest_age, priority), queue=priority.name.lower(), channel=channel.id)
+            try:
+                async with TaskGroup() as group:
+                    group.create_task(se_to_discord.run())
+                    group.create_task(discord_to_se.run())
+                    self.logger.info(f"Started two-way forwarder between room {room.room_id} and channel {channel.name} in guild {channel.guild.name} after {monotonic() - self.started_at:.1f}s")
+            except* NotFound as errors:
+                if self.webhook_gone(errors):
+                    await self.forget_webhook(dual_key(config))
+                raise
+            finally:
+                # the bridge may be moving to another worker, so stop forwarding to it
+                self.se_forwarders.pop(channel, None)
+                self.room_forwarders.pop(dual_key(config), None)
+                self.room_hub.detach(room)
+                metrics.queue_depth.untrack(queue="pipeline", room=room.room_id)
+                for priority in Priority:
+                    metrics.queue_depth.untrack(queue=priority.name.lower(), channel=channel.id)
+                    metrics.queue_age.untrack(queue=priority.name.lower(), channel=channel.id)
 
+    def bridge_configs(self, config: Configuration) -> dict[str, SingleBridge | DualBridge]:
+        return {single_key(bridge): bridge for bridge in config["single"]} | {dual_key(bridge): bridge for bridge in config["dual"]}
+
+    def bridge_runs(self, config: Configuration):
+        runs: dict[str, Callable[[], Awaitable[None]]] = {
+            single_key(bridge): partial(self.run_one_way, bridge, self.records, self.credentials)
+            for bridge in config["single"]
+        }
+        for bridge in config["dual"]:
+            # with gateway sharding we only see our own shard's guilds, and
+            # only get events for them too
+            if self.shard_count is None or self.get_channel(bridge["channel"]) is not None:
+                runs[dual_key(bridge)] = partial(self.run_two_way, bridge, self.records, self.credentials)
+        return runs
+
+    def restricted_bridges(self, config: Configuration):
+        # dual bridges need their channel in our gateway shard. single ones only
+        # talk to their webhook, which works from any shard
+        if self.shard_count is None:
+            return set()
+        return {dual_key(bridge) for bridge in config["dual"]}
+
+    def start_bridge(self, key: str, run: Callable[[], Awaitable[None]]):
+        assert self.bridge_group is not None
+        self.bridge_tasks[key] = self.bridge_group.create_task(run(), name=key)
+
+    async def stop_bridge(self, key: str):
+        if (task := self.bridge_tasks.pop(key, None)) is not None:
+            task.cancel()
+            await gather(task, return_exceptions=True)
+
+    def update_bridge(self, key: str, bridge: SingleBridge | DualBridge):
+        if (forwarder := self.room_forwarders.get(key)) is not None:
+            forwarder.suppress_embeds_for = bridge.get("noembed", [])
+        if "channel" in bridge:
+            self.ignore.setdefault(bridge["channel"], set()).clear()
+            self.ignore[bridge["channel"]].update(bridge["ignore"])
+            if (channel := self.get_channel(bridge["channel"])) is not None and (discord_to_se := self.se_forwarders.get(channel)) is not None: # type: ignore
+                discord_to_se.role_symbols = bridge["roleIcons"]
+                discord_to_se.ignore = bridge["ignore"]
+
+    async def reload(self):
+        # only bridges are reloaded; everything else is only read at startup
+        async with self._reload_lock:
+            with open(self.config_path) as file:
+                config: Configuration = json.load(file)
+            # sharding and metrics get adjusted per worker, so they never match the file
+            if stale := [key for key in config.keys() | self.config.keys() if key not in ("single", "dual", "sharding", "metrics") and config.get(key) != self.config.get(key)]:
+                self.logger.warning(f"Restart to apply changes to {', '.join(sorted(stale))}")
+            old, new = self.bridge_configs(self.config), self.bridge_configs(config)
+            self.config["single"], self.config["dual"] = config["single"], config["dual"]
+
+            def structural(bridge: SingleBridge | DualBridge):
+                return {field: value for field, value in bridge.items() if field not in self.hot_fields}
+            added = new.keys() - old.keys()
+            removed = old.keys() - new.keys()
+            changed = {key for key in old.keys() & new.keys() if old[key] != new[key]}
+            restarted = {key for key in changed if structural(old[key]) != structural(new[key])}
+            for key in changed - restarted:
+                self.update_bridge(key, new[key])
+            for key in added | restarted:
+                if "channel" in new[key]:
+                    self.update_bridge(key, new[key])
+
+            runs = self.bridge_runs(config)
+            if self.coordinator is not None:
+                await self.coordinator.update(runs, self.restricted_bridges(config), restarted)
+            else:
+                for key in removed | restarted:
+                    await self.stop_bridge(key)
+                for key in added | restarted:
+                    self.start_bridge(key, runs[key])
+            for key in removed:
+                if "channel" in old[key]:
+                    self.ignore.pop(old[key]["channel"], None) # type: ignore
+            summary = f"{len(added)} added, {len(removed)} removed, {len(restarted)} restarted, {len(changed - restarted)} updated in place"
+            self.logger.info(f"Reloaded configuration: {summary}")
+            return summary
+
+    async def reload_logged(self):
+        try:
+            await self.reload()
+        except Exception:
+            self.logger.exception("Failed to reload configuration")
+
+    async def is_owner(self, user: User | Member):
+        # whoever runs the bot, as opposed to an admin of one of the guilds it's in
+        info = await self.application_info()
+        if info.team is not None:
+            return any(member.id == user.id for member in info.team.members)
+        return info.owner.id == user.id
+
+    async def reload_command(self, interaction: Interaction):
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        if not await self.is_owner(interaction.user):
+            await interaction.followup.send("Only the bot's owner can reload its configuration.", ephemeral=True)
+            return
+        try:
+            summary = await self.reload()
+        except Exception as e:
+            self.logger.exception("Failed to reload configuration")
+            await interaction.followup.send(f"Reload failed: {e}", ephemeral=True)
+        else:
+            await interaction.followup.send(f"Reloaded: {summary}.", ephemeral=True)
+
+    async def log_first_forward(self):
+        await metrics.first_forward.wait()
+        self.logger.info(f"First message forwarded {monotonic() - self.started_at:.1f}s after startup")
 
     async def run(self) -> None:
-        engine = AIOEngine(AsyncIOMotorClient(self.config["database"]["uri"]), self.config["database"]["name"])
-        credentials = await Credentials.load_or_authenticate("credentials.dat", self.config["chat"]["email"], self.config["chat"]["password"])
-        await self.login(self.config["token"])
-
-        async with self, TaskGroup() as group:
-            group.create_task(self.connect())
-            await self.wait_until_ready()
-            
-            for config in self.config["single"]:
-                group.create_task(self.run_one_way(config, engine, credentials))
-            
-            for config in self.config["dual"]:
-                group.create_task(self.run_two_way(config, engine, credentials))
-
-            self.logger.info("Forwarders started.")
+        self.started_at = monotonic()
+        self.engine = engine = AIOEngine(AsyncIOMotorClient(self.config["database"]["uri"]), self.config["database"]["name"])
+        records = BridgeRecords(engine)
+        for name, cache in (("records", records), ("pfp", self.pfp_fetcher.pfp_cache), ("attachments", self.uploader.by_attachment), ("attachment_hashes", self.uploader.by_hash)):
+            metrics.cache_hits.track(partial(getattr, cache, "hits"), cache=name)
+            metrics.cache_misses.track(partial(getattr, cache, "misses"), cache=name)
+        metrics.queue_depth.track(lambda: records.pending, queue="record_writes")
+        if "journal" in self.config:
+            self.journal = open_journal(self.config["journal"], engine)
+            if "sharding" in self.config and self.config["journal"]["type"] == "file":
+                self.logger.warning("A file journal can't be replayed by other workers when a bridge fails over, use the mongo journal")
+        # none of these depend on each other
+        _, credentials, _ = await gather(
+            migrate(engine, self.config.get("retention")),
+            Credentials.load_or_authenticate("credentials.dat", self.config["chat"]["email"], self.config["chat"]["password"]),
+            self.login(self.config["token"]),
+        )
+        self.pfp_fetcher.load()
+        metrics_runner = None
+        if "metrics" in self.config:
+            metrics_runner = await metrics.serve_metrics(self.config["metrics"].get("host", "127.0.0.1"), self.config["metrics"]["port"])
+
+        try:
+            async with self, TaskGroup() as group:
+                group.create_task(self.connect())
+                group.create_task(records.run())
+                group.create_task(self.log_first_forward())
+                if self.journal is not None:
+                    group.create_task(self.journal.run())
+                if "retention" in self.config:
+                    group.create_task(run_retention(engine, self.config["retention"]))
+
+                self.records, self.credentials, self.bridge_group = records, credentials, group
+                if hasattr(signal, "SIGHUP"):
+                    get_running_loop().add_signal_handler(signal.SIGHUP, lambda: group.create_task(self.reload_logged()))
+                if "sharding" in self.config:
+                    await self.wait_until_ready()
+                    bridges = self.bridge_runs(self.config)
+                    sharding = self.config["sharding"]
+                    self.coordinator = LeaseCoordinator(
+                        engine,
+                        sharding.get("worker", f"{gethostname()}/{getpid()}"),
+                        lease_time=sharding.get("leaseSeconds", 30),
+                        interval=sharding.get("leaseSeconds", 30) / 3,
+                        max_bridges=sharding.get("maxBridges"),
+                        group=f"shard/{self.shard_id}" if self.shard_count is not None else None,
+                    )
+                    group.create_task(self.coordinator.run(bridges, self.restricted_bridges(self.config)))
+                    self.logger.info(f"Started as worker {self.coordinator.worker}, {len(bridges)} bridges eligible.")
+                else:
+                    # bridges set themselves up while the gateway connects
+                    for key, run in self.bridge_runs(self.config).items():
+                        self.start_bridge(key, run)
+                    self.logger.info("Forwarders starting.")
+        finally:
+            self.room_hub.close()
+            self.pfp_fetcher.save()
+            await self.chat_http.close()
+            self.conversions.close()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
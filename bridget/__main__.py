@@ -1,12 +1,71 @@
 import json
 import asyncio
+from copy import deepcopy
+from logging import getLogger
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+import os
+import signal
+from time import sleep
 
 from discord.utils import setup_logging
+from sechat import Credentials
 from bridget import BridgetClient
+from bridget.models import Configuration
 
-with open("config.json") as file:
-    config = json.load(file)
+def run(config: Configuration, config_path: str = "config.json"):
+    setup_logging()
+    bridget = BridgetClient(config, config_path)
+    asyncio.run(bridget.run())
 
-setup_logging()
-bridget = BridgetClient(config)
-asyncio.run(bridget.run())
\ No newline at end of file
+def worker_config(config: Configuration, index: int):
+    # each local worker gets its own gateway shard and metrics port
+    config = deepcopy(config)
+    sharding = config["sharding"]
+    sharding["processes"] = 1
+    if "worker" in sharding:
+        sharding["worker"] = f"{sharding['worker']}/{index}"
+    if "shardCount" in sharding:
+        sharding["firstShard"] = (sharding.get("firstShard", 0) + index) % sharding["shardCount"]
+    if "metrics" in config:
+        config["metrics"]["port"] += index
+    return config
+
+def supervise(config: Configuration, processes: int):
+    # log in once up front so the workers don't all race to write credentials.dat
+    setup_logging()
+    logger = getLogger("Supervisor")
+    asyncio.run(Credentials.load_or_authenticate("credentials.dat", config["chat"]["email"], config["chat"]["password"]))
+    context = get_context("spawn")
+    workers = {}
+    def start(index: int):
+        process = context.Process(target=run, args=(worker_config(config, index),), name=f"bridget-{index}")
+        process.start()
+        workers[process.sentinel] = (index, process)
+    def reload(*_):
+        # workers reload their bridges themselves, this just keeps restarts current
+        nonlocal config
+        with open("config.json") as file:
+            config = json.load(file)
+        for _, process in workers.values():
+            os.kill(process.pid, signal.SIGHUP)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload)
+    for index in range(processes):
+        start(index)
+    while True:
+        # the other workers take over a dead one's bridges until it's back
+        for sentinel in wait(list(workers)):
+            index, process = workers.pop(sentinel)
+            logger.warning(f"Worker {index} exited with {process.exitcode}, restarting")
+            sleep(5)
+            start(index)
+
+if __name__ == "__main__":
+    with open("config.json") as file:
+        config = json.load(file)
+
+    if (processes := config.get("sharding", {}).get("processes", 1)) > 1:
+        supervise(config, processes)
+    else:
+        run(config)
@@ -1,80 +1,140 @@
+from asyncio import gather
 from typing import Optional
-from itertools import chain
 
-from discord import Guild
+from discord import Forbidden, Guild, NotFound
 from discord_markdown_ast_parser import parse
 from discord_markdown_ast_parser.parser import NodeType, Node
 
+from bridget.metrics import conversion_time
+from bridget.util import MINUTE, TTLCache
+
 class Chatifier:
-    def __init__(self, guild: Guild):
+    def __init__(self, guild: Guild, ttl: float = 10 * MINUTE):
         self.guild = guild
+        # there's no invalidation for these without the members intent, so the ttl is all there is
+        self.member_names: TTLCache[int, str] = TTLCache(1024, ttl)
+        self.channel_names: TTLCache[int, str] = TTLCache(256, ttl)
+
+    def invalidate_channel(self, channel_id: int):
+        self.channel_names.pop(channel_id)
+
+    def collect_mentions(self, nodes: list[Node], users: set[int], channels: set[int]):
+        for node in nodes:
+            if node.node_type == NodeType.USER and node.discord_id is not None:
+                users.add(node.discord_id)
+            elif node.node_type == NodeType.CHANNEL and node.discord_id is not None:
+                channels.add(node.discord_id)
+            if node.children is not None:
+                self.collect_mentions(node.children, users, channels)
+
+    async def fetch_channel_name(self, channel_id: int):
+        try:
+            channel = await self.guild.fetch_channel(channel_id)
+        except (NotFound, Forbidden):
+            return
+        self.channel_names.put(channel_id, channel.name)
+
+    async def resolve_mentions(self, nodes: list[Node]):
+        # find every mention up front so the misses can be fetched in one go,
+        # rather than one REST call per mention
+        users: set[int] = set()
+        channels: set[int] = set()
+        self.collect_mentions(nodes, users, channels)
+        missing_users = []
+        for user_id in users:
+            if self.member_names.get(user_id) is not None:
+                continue
+            if (member := self.guild.get_member(user_id)) is not None:
+                self.member_names.put(user_id, member.display_name)
+            else:
+                missing_users.append(user_id)
+        missing_channels = []
+        for channel_id in channels:
+            if self.channel_names.get(channel_id) is not None:
+                continue
+            if (channel := self.guild.get_channel_or_thread(channel_id)) is not None:
+                self.channel_names.put(channel_id, channel.name)
+            else:
+                missing_channels.append(channel_id)
+        for start in range(0, len(missing_users), 100):
+            batch = missing_users[start:start + 100]
+            for member in await self.guild.query_members(user_ids=batch, limit=len(batch)):
+                self.member_names.put(member.id, member.display_name)
+        await gather(*(self.fetch_channel_name(channel_id) for channel_id in missing_channels))
 
-    async def convert_children(self, node: Node):
+    def render_children(self, node: Node, output: list[str]):
         if node.children is None:
             return
         for child in node.children:
-            async for string in self.convert_node(child):
-                yield string
-    async def wrap(self, node: Node, start: str, end: Optional[str] = None):
-        yield start
-        async for string in self.convert_children(node):
-            yield string
-        yield end if end is not None else start
+            self.render_node(child, output)
+
+    def wrap(self, node: Node, output: list[str], start: str, end: Optional[str] = None):
+        output.append(start)
+        self.render_children(node, output)
+        output.append(end if end is not None else start)
+
+    def prefix_lines(self, node: Node, output: list[str], prefix: str):
+        inner: list[str] = []
+        self.render_children(node, inner)
+        for line in "".join(inner).splitlines(True):
+            output.append(prefix)
+            output.append(line)
 
-    async def convert_node(self, node: Node):
+    def render_node(self, node: Node, output: list[str]):
+        # mentions must already be resolved, see resolve_mentions
         match node.node_type:
             case NodeType.TEXT:
                 assert node.text_content is not None
-                yield node.text_content
+                output.append(node.text_content)
             case NodeType.ITALIC | NodeType.BOLD | NodeType.UNDERLINE:
-                async for string in self.wrap(node, "_"):
-                    yield string
+                self.wrap(node, output, "_")
             case NodeType.STRIKETHROUGH:
-                async for string in self.wrap(node, "---"):
-                    yield string
+                self.wrap(node, output, "---")
             case NodeType.SPOILER:
-                async for string in self.wrap(node, "[spoiler](https://spoiler \"", "\")"):
-                    yield string
+                self.wrap(node, output, "[spoiler](https://spoiler \"", "\")")
             case NodeType.CODE_INLINE:
-                async for string in self.wrap(node, "`"):
-                    yield string
+                self.wrap(node, output, "`")
             case NodeType.USER:
                 assert node.discord_id is not None
-                member = await self.guild.fetch_member(node.discord_id)
-                if member is None:
-                    yield "@!<unknown user>"
+                name = self.member_names.get(node.discord_id)
+                if name is None:
+                    output.append("@!<unknown user>")
                 else:
-                    yield f"@!{member.display_name}"
+                    output.append(f"@!{name}")
             case NodeType.ROLE:
                 assert node.discord_id is not None
                 role = self.guild.get_role(node.discord_id)
                 if role is None:
-                    yield "@!<unknown role>"
+                    output.append("@!<unknown role>")
                 else:
-                    yield f"@!{role.name}"
+                    output.append(f"@!{role.name}")
             case NodeType.CHANNEL:
                 assert node.discord_id is not None
-                channel = await self.guild.fetch_channel(node.discord_id)
-                if channel is None:
-                    yield "#<unknown channel>"
+                name = self.channel_names.get(node.discord_id)
+                if name is None:
+                    output.append("#<unknown channel>")
                 else:
-                    yield f"#{channel.name}"
+                    output.append(f"#{name}")
             case NodeType.EMOJI_CUSTOM | NodeType.EMOJI_UNICODE_ENCODED:
                 assert node.emoji_name is not None
-                yield f":{node.emoji_name}:"
+                output.append(f":{node.emoji_name}:")
             case NodeType.URL_WITH_PREVIEW | NodeType.URL_WITHOUT_PREVIEW:
                 assert node.url is not None
-                yield node.url
+                output.append(node.url)
             case NodeType.QUOTE_BLOCK:
-                for line in "".join([i async for i in self.convert_children(node)]).splitlines(True):
-                    yield f"> {line}"
+                self.prefix_lines(node, output, "> ")
             case NodeType.CODE_BLOCK:
-                for line in "".join([i async for i in self.convert_children(node)]).splitlines(True):
-                    yield f"    {line}"
+                self.prefix_lines(node, output, "    ")
 
     async def convert(self, message: str):
         nodes = parse(message)
+        await self.resolve_mentions(nodes)
+        output: list[str] = []
+        # mention lookups are network-bound, only time the actual rendering
+        with conversion_time.time(direction="discord_to_se", path="full"):
+            for node in nodes:
+                self.render_node(node, output)
         if len(nodes) == 1 and nodes[0].node_type in (NodeType.QUOTE_BLOCK, NodeType.CODE_BLOCK):
-            return "".join([i async for i in self.convert_node(nodes[0])])
+            return "".join(output)
         else:
-            return "".join(chain(*[[i async for i in self.convert_node(node)] for node in nodes])).strip("\n")
\ No newline at end of file
+            return "".join(output).strip("\n")
@@ -0,0 +1,104 @@
+from asyncio import Semaphore, get_running_loop
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import html
+import json
+from multiprocessing import get_context
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Callable, Literal, TypeVar
+
+from discord import Embed
+
+from bridget.metrics import conversion_time
+from bridget.models import ConversionConfig
+
+if TYPE_CHECKING:
+    from bridget.discordifier import Discordifier
+
+T = TypeVar("T")
+
+# these run on the pool, so they only take and return plain data.
+# each worker process gets its own converter the first time it's needed, which
+# is also when bs4, lxml and markdownify get imported, so they don't slow down startup
+_converter: "Discordifier | None" = None
+
+def converter():
+    global _converter
+    if _converter is None:
+        from bridget.discordifier import Discordifier
+        _converter = Discordifier()
+    return _converter
+
+def convert_full(content: str) -> str | dict | None:
+    converted = converter().convert_full(content)
+    if isinstance(converted, Embed):
+        return converted.to_dict()
+    return converted
+
+def convert_description(description: str) -> str | None:
+    from bs4 import BeautifulSoup
+    converted = converter().convert(BeautifulSoup(description, features="lxml"))
+    if isinstance(converted, Embed):
+        return converted.description
+    return converted
+
+def parse_room_users(page: bytes) -> list[dict]:
+    from bs4 import BeautifulSoup, Tag
+    soup = BeautifulSoup(page, features="lxml")
+    assert isinstance(user_list := soup.find(class_="js-present"), Tag)
+    return json.loads(html.unescape(user_list.attrs["data-users"])) # type: ignore
+
+
+class ConversionPool:
+    # keeps HTML parsing off the event loop, so a burst of oneboxes can't hold up
+    # gateway heartbeats and every other bridge. anything the regex fast path can
+    # handle, or that's small enough that the hop costs more than the parse, stays inline
+    def __init__(self, executor: Literal["inline", "thread", "process"] = "inline", workers: int = 2, queue_size: int = 64, inline_below: int = 256):
+        self.inline_below = inline_below
+        self.executor: Executor | None = None
+        match executor:
+            case "thread":
+                self.executor = ThreadPoolExecutor(workers, thread_name_prefix="conversion")
+            case "process":
+                # the workers start lazily, long after motor and discord.py have
+                # threads running, and forking then can deadlock
+                self.executor = ProcessPoolExecutor(workers, mp_context=get_context("spawn"))
+        self.offloaded = 0
+        self._slots = Semaphore(queue_size)
+
+    @classmethod
+    def from_config(cls, config: ConversionConfig | None):
+        if config is None:
+            return cls()
+        return cls(config["executor"], config.get("workers", 2), config.get("queueSize", 64), config.get("inlineBelow", 256))
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        if self.executor is None:
+            return fn(*args)
+        # bounded, so a flood queues up here instead of inside the executor
+        async with self._slots:
+            self.offloaded += 1
+            started_at = perf_counter()
+            try:
+                return await get_running_loop().run_in_executor(self.executor, fn, *args)
+            finally:
+                conversion_time.observe(perf_counter() - started_at, direction="se_to_discord", path="pool")
+
+    async def convert_html(self, content: str):
+        if (converted := converter().convert_fast(content)) is not None:
+            return converted
+        if self.executor is None or len(content) < self.inline_below:
+            return converter().convert_full(content)
+        converted = await self.run(convert_full, content)
+        if isinstance(converted, dict):
+            return Embed.from_dict(converted)
+        return converted
+
+    async def convert_description(self, description: str):
+        return await self.run(convert_description, description)
+
+    async def parse_room_users(self, page: bytes):
+        return await self.run(parse_room_users, page)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
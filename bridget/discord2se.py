@@ -1,51 +1,76 @@
-from io import BytesIO
 import json
-from typing import TYPE_CHECKING
 from datetime import datetime
-from asyncio import Lock, Queue, TaskGroup, sleep
+from asyncio import Event, TaskGroup, TimerHandle, gather, get_running_loop
+from functools import partial
+from logging import getLogger
+from typing import Awaitable, Callable
 
-
-from aiohttp import ClientSession
-from discord import Member, Message, Object, TextChannel, User
-from discord.utils import find
-from odmantic import AIOEngine
+from aiohttp import ClientError
+from discord import Forbidden, Member, Message, NotFound, Object, TextChannel, User
+from discord.utils import find, utcnow
 from sechat import Room
-from sechat.errors import OperationFailedError
 
 from bridget.chatifier import Chatifier
-from bridget.models import BridgedMessage
+from bridget.http import ChatHTTP
+from bridget.journal import Journal
+from bridget.metrics import discord_to_se_latency, first_forward
+from bridget.models import BridgedMessage, JournalEntry
+from bridget.records import BridgeRecords
+from bridget.scheduler import ChatScheduler, Priority
+from bridget.uploads import AttachmentUploader
 
 class DiscordToSEForwarder:
     max_message_length = 500
+    typing_timeout = 10
+    # once this many sends are queued, or the oldest has waited this long,
+    # consecutive messages from the same author get batched together
+    batch_backlog = 5
+    batch_age = 10
+    max_batch_size = 5
+    # batches stay on one line, since chat only renders markdown in single-line messages
+    batch_separator = " | "
+    # connection trouble gets retried this many times, backing off from retry_delay
+    max_retries = 3
+    retry_delay = 5
     supported_content_types = {"image/png", "image/jpeg", "image/webp", "image/bmp", "image/gif"}
 
-    def __init__(self, room: Room, engine: AIOEngine, channel: TextChannel, client_id: int, role_symbols: dict[str, str], ignore: list[int]):
+    def __init__(self, room: Room, records: BridgeRecords, http: ChatHTTP, uploader: AttachmentUploader, channel: TextChannel, client_id: int, role_symbols: dict[str, str], ignore: list[int], journal: Journal | None = None):
         self.room = room
-        self.engine = engine
+        self.records = records
+        self.http = http
+        self.uploader = uploader
         self.client_id = client_id
         self.channel = channel
         self.role_symbols = role_symbols
         self.ignore = ignore
         self.converter = Chatifier(channel.guild)
+        self.journal = journal
+        self.logger = getLogger("DiscordToSEForwarder")
 
-        self._send_queue: Queue[Message] = Queue()
-        self._edit_queue: Queue[Message] = Queue()
-        self._delete_queue: Queue[Message] = Queue()
-        self.notification_queue: Queue[tuple[str, int]] = Queue()
+        # new messages, edits, deletes and notifications all share chat's ratelimit
+        self.scheduler = ChatScheduler()
+        self._pending_sends: dict[int, Message] = {}
 
-        self._typing_lock = Lock()
-        self._last_typed_at: dict[int, datetime] = {}
+        # who's typing, by id, with an expiry timer each; the typing task only
+        # wakes up when this actually changes
+        self._typing_names: dict[int, str] = {}
+        self._typing_expiry: dict[int, TimerHandle] = {}
+        self._typing_changed = Event()
         
 
-    def can_modify(self, dt: datetime):
+    def can_modify(self, dt: datetime | None):
         # we use 2 minutes instead of 2.5 because any number of things may intervene
         # and cause us to go over if we use 2.5
         # which means an error, and I don't want to risk the whole thing imploding
-        return (datetime.now() - dt).seconds < (60 * 2)
+        # archived records don't keep a timestamp, and they're long past editable anyway
+        return dt is not None and (datetime.now() - dt).seconds < (60 * 2)
+
+    def observe_sent(self, message: Message):
+        discord_to_se_latency.observe((utcnow() - message.created_at).total_seconds(), channel=self.channel.id)
+        first_forward.set()
 
     async def get_bridge_record(self, discord_id: int):
-        if (message := await self.engine.find_one(BridgedMessage, BridgedMessage.discord_message_id == discord_id)) is not None:
-            return message
+        return await self.records.by_discord_id(discord_id)
 
     def format_display_name(self, user: User | Member):
         # TODO: this is awful
@@ -59,7 +84,7 @@ class DiscordToSEForwarder:
             symbols = " " + symbols
         return f"[{user.display_name}{symbols}]"
 
-    async def convert_message(self, message: Message, note: str = ""):
+    async def convert_content(self, message: Message):
         content = await self.converter.convert(message.content)
         if content.count("\n") == 0:
             if message.poll is not None:
@@ -68,17 +93,19 @@ class DiscordToSEForwarder:
                 content += " <embed>"
             elif len(message.embeds) > 1:
                 content += f" <{len(message.embeds)} embeds>"
+            urls = iter(await gather(*(
+                self.uploader.upload(self.room, attachment)
+                for attachment in message.attachments
+                if attachment.content_type in self.supported_content_types
+            )))
             for attachment in message.attachments:
-                if attachment.content_type in self.supported_content_types:
-                    buffer = BytesIO(await attachment.read())
-                    try:
-                        url = await self.room.upload_image(buffer, attachment.filename)
-                    except OperationFailedError:
-                        content += f" `{attachment.filename}`"
-                    else:
-                        content += f" [{attachment.filename}]({url})"
+                if attachment.content_type in self.supported_content_types and (url := next(urls)) is not None:
+                    content += f" [{attachment.filename}]({url})"
                 else:
                     content += f" `{attachment.filename}`"
+        return content
+
+    async def format_message(self, message: Message, content: str, note: str = ""):
         prefix = note + self.format_display_name(message.author)
         reply = ""
         if message.reference is not None and message.reference.message_id is not None:
@@ -95,109 +122,288 @@ class DiscordToSEForwarder:
             content = f"{reply} {self.format_display_name(message.author)} {content}"
         return content
 
+    async def convert_message(self, message: Message, note: str = ""):
+        return await self.format_message(message, await self.convert_content(message), note)
+
+    def should_batch(self):
+        return self.scheduler.depth(Priority.SEND) >= self.batch_backlog or self.scheduler.oldest_age(Priority.SEND) >= self.batch_age
+
+    def can_batch(self, message: Message, content: str):
+        # replies, quotes and code blocks need a chat message of their own
+        return (
+            message.reference is None
+            and "\n" not in content
+            and len(content) <= self.max_message_length
+            and not content.startswith(("    ", "> "))
+        )
+
+    def merge_contents(self, author: User | Member, contents: list[str]):
+        return f" {self.format_display_name(author)} " + self.batch_separator.join(contents)
+
+    async def collect_batch(self, first: Message, first_content: str):
+        # take the author's next queued messages for as long as they fit, stopping
+        # at anyone else's so the conversation doesn't get reordered
+        batch: list[tuple[Message, str]] = []
+        contents = [first_content]
+        for message in list(self._pending_sends.values()):
+            if len(batch) + 1 >= self.max_batch_size:
+                break
+            if message.id <= first.id:
+                # sent before this one, so it isn't part of what follows it
+                continue
+            if message.author.id != first.author.id or message.reference is not None or "\n" in message.content:
+                break
+            del self._pending_sends[message.id]
+            content = await self.convert_content(message)
+            if not self.can_batch(message, content) or len(self.merge_contents(first.author, [*contents, content])) > self.max_message_length:
+                # leave it for its own send job
+                self._pending_sends[message.id] = message
+                break
+            contents.append(content)
+            batch.append((message, content))
+        return batch
+
+    async def fetch_batch(self, record: BridgedMessage, edited: Message | None = None, without: int | None = None):
+        messages = []
+        for discord_id in (record.discord_message_id, *record.merged_discord_message_ids):
+            if discord_id == without:
+                continue
+            if edited is not None and discord_id == edited.id:
+                messages.append(edited)
+                continue
+            try:
+                messages.append(await self.channel.fetch_message(discord_id))
+            except (NotFound, Forbidden):
+                pass
+        return messages
+
+    async def convert_batch(self, messages: list[Message]):
+        return self.merge_contents(messages[0].author, [await self.convert_content(message) for message in messages])
+
+    def journal_entry(self, **fields):
+        if self.journal is None:
+            return None
+        return self.journal.append(JournalEntry(channel_id=self.channel.id, **fields))
+
+    def ack(self, entry: JournalEntry | None):
+        # not until its record is written, or a replay after a crash would
+        # send it again, or lose track of what to edit or delete
+        if entry is not None and self.journal is not None:
+            self.records.after_flush(partial(self.journal.ack, entry))
+
+    def submit(self, priority: Priority, key: int, run: Callable[[], Awaitable[None]], entry: JournalEntry | None, attempt: int = 0):
+        async def job():
+            try:
+                await run()
+            except (OSError, ClientError) as e:
+                # connection trouble, which includes timeouts
+                if attempt < self.max_retries:
+                    delay = self.retry_delay * 2 ** attempt
+                    self.logger.warning(f"{priority.name.lower()} job for {key} failed with {e!r}, retrying in {delay}s")
+                    get_running_loop().call_later(delay, self.submit, priority, key, run, entry, attempt + 1)
+                    return
+                # better dropped than replayed hours later on the next restart
+                if entry is not None:
+                    self.logger.warning(f"Dropping journaled {entry.kind} {entry.id} after {attempt + 1} attempts")
+                self.ack(entry)
+                raise
+            except Exception:
+                # it'll fail the same way every time, so don't replay it on every restart
+                if entry is not None:
+                    self.logger.warning(f"Dropping journaled {entry.kind} {entry.id} after it failed")
+                self.ack(entry)
+                raise
+            self.ack(entry)
+        self.scheduler.submit(priority, key, job)
+
+    def submit_send(self, message: Message, entry: JournalEntry | None):
+        self._pending_sends[message.id] = message
+        self.submit(Priority.SEND, message.author.id, partial(self._send, message.id), entry)
+
+    def submit_notification(self, text: str, se_message_id: int, entry: JournalEntry | None = None):
+        if entry is None:
+            entry = self.journal_entry(kind="notify", text=text, se_message_id=se_message_id)
+        self.submit(Priority.NOTIFY, self.client_id, partial(self._notify, text, se_message_id), entry)
+
     async def queue_message(self, message: Message):
-        await self._send_queue.put(message)
-        async with self._typing_lock:
-            self._last_typed_at.pop(message.author.id, None)
+        self.submit_send(message, self.journal_entry(kind="send", discord_message_id=message.id))
+        self.stop_typing(message.author.id)
 
     async def queue_edit(self, message: Message):
-        await self._edit_queue.put(message)
+        if message.id in self._pending_sends:
+            # hasn't been sent yet, so just send the edited version when it is
+            self._pending_sends[message.id] = message
+            return
+        entry = self.journal_entry(kind="edit", discord_message_id=message.id)
+        self.submit(Priority.MODIFY, message.author.id, partial(self._edit, message), entry)
 
     async def queue_delete(self, message: Message):
-        await self._delete_queue.put(message)
+        if self._pending_sends.pop(message.id, None) is not None:
+            return
+        entry = self.journal_entry(kind="delete", discord_message_id=message.id)
+        self.submit(Priority.MODIFY, message.author.id, partial(self._delete, message.id), entry)
+
+    async def fetch_journaled_message(self, entry: JournalEntry):
+        assert entry.discord_message_id is not None
+        if entry.kind == "send" and await self.get_bridge_record(entry.discord_message_id) is not None:
+            # sent, but we went down before the acknowledgement was written
+            return None
+        try:
+            return await self.channel.fetch_message(entry.discord_message_id)
+        except (NotFound, Forbidden):
+            return None
+
+    async def replay(self):
+        # requeue whatever was left over from last time; call before taking live traffic
+        if self.journal is None:
+            return 0
+        entries = await self.journal.pending(self.channel.id)
+        messages = await gather(*(self.fetch_journaled_message(entry) for entry in entries if entry.kind in ("send", "edit")))
+        fetched = iter(messages)
+        for entry in entries:
+            match entry.kind:
+                case "send" | "edit":
+                    if (message := next(fetched)) is None:
+                        self.journal.ack(entry)
+                    elif entry.kind == "send":
+                        self.submit_send(message, entry)
+                    else:
+                        self.submit(Priority.MODIFY, message.author.id, partial(self._edit, message), entry)
+                case "delete":
+                    assert entry.discord_message_id is not None
+                    self.submit(Priority.MODIFY, self.client_id, partial(self._delete, entry.discord_message_id), entry)
+                case "notify":
+                    assert entry.text is not None and entry.se_message_id is not None
+                    self.submit_notification(entry.text, entry.se_message_id, entry)
+        return len(entries)
 
     async def queue_typing(self, member: Member):
-        async with self._typing_lock:
-            self._last_typed_at[member.id] = datetime.now()
+        if (expiry := self._typing_expiry.pop(member.id, None)) is not None:
+            expiry.cancel()
+        self._typing_expiry[member.id] = get_running_loop().call_later(self.typing_timeout, self.stop_typing, member.id)
+        if self._typing_names.get(member.id) != member.display_name:
+            self._typing_names[member.id] = member.display_name
+            self._typing_changed.set()
+
+    def stop_typing(self, member_id: int):
+        if (expiry := self._typing_expiry.pop(member_id, None)) is not None:
+            expiry.cancel()
+        if self._typing_names.pop(member_id, None) is not None:
+            self._typing_changed.set()
 
-    async def _delete_task(self):
-        while True:
-            message = await self._delete_queue.get()
-            if (bridge_record := await self.get_bridge_record(message.id)) is not None:
+    async def _notify(self, text: str, se_message_id: int):
+        await self.scheduler.call(self.room.send, text, se_message_id)
+
+    async def _delete(self, message_id: int):
+        if (bridge_record := await self.get_bridge_record(message_id)) is not None:
+            if len(bridge_record.merged_discord_message_ids) and len(remaining := await self.fetch_batch(bridge_record, without=message_id)):
+                # only part of a batch went away, so rewrite what's left of it
                 if self.can_modify(bridge_record.received_at):
-                    await self.room.delete(bridge_record.se_message_id)
+                    await self.scheduler.call(self.room.edit, bridge_record.se_message_id, await self.convert_batch(remaining))
                 else:
-                    await self.notification_queue.put(("Message was deleted", bridge_record.se_message_id))
-                await self.engine.delete(bridge_record)
-            self._delete_queue.task_done()
-
-    async def _edit_task(self):
-        while True:
-            message = await self._edit_queue.get()
-            bridge_record = await self.get_bridge_record(message.id)
-            new_content = await self.convert_message(message)
-            if len(new_content) > self.max_message_length and new_content.count("\n") == 0:
-                await message.add_reaction("📏")
+                    self.submit_notification("Part of message was deleted", bridge_record.se_message_id)
+                self.records.forget(bridge_record)
+                bridge_record.discord_message_id = remaining[0].id
+                bridge_record.merged_discord_message_ids = [part.id for part in remaining[1:]]
+                await self.records.save(bridge_record)
+                return
+            if self.can_modify(bridge_record.received_at):
+                await self.scheduler.call(self.room.delete, bridge_record.se_message_id)
             else:
-                if find(lambda r: r.emoji == "📏", message.reactions) is not None:
-                    await message.remove_reaction("📏", Object(self.client_id))
-                if bridge_record is None:
-                    # we've never sent this message, possibly because it was too long
-                    await self._send_queue.put(message)
-                elif not self.can_modify(bridge_record.received_at):
-                    await message.reply("Your edit was ignored because the edit window expired, sorry!")
-                else:
-                    await self.room.edit(bridge_record.se_message_id, new_content)
-            self._edit_queue.task_done()
-            
-    async def _send_task(self):
-        while True:
-            # new messages and edits share a ratelimit, so give edits priority
-            # since they're time-sensitive
-            await self._edit_queue.join()
-            message = await self._send_queue.get()
-            content = await self.convert_message(message)
-            if len(content) > self.max_message_length and content.count("\n") == 0:
-                await message.add_reaction("📏")
+                self.submit_notification("Message was deleted", bridge_record.se_message_id)
+            await self.records.delete(bridge_record)
+
+    async def _edit(self, message: Message):
+        bridge_record = await self.get_bridge_record(message.id)
+        if bridge_record is not None and len(bridge_record.merged_discord_message_ids):
+            new_content = await self.convert_batch(await self.fetch_batch(bridge_record, edited=message))
+            # a part that's been edited onto several lines can't stay in a one-line batch
+            too_long = len(new_content) > self.max_message_length or "\n" in new_content
+        else:
+            new_content = await self.convert_message(message)
+            too_long = len(new_content) > self.max_message_length and new_content.count("\n") == 0
+        if too_long:
+            await message.add_reaction("📏")
+        else:
+            if find(lambda r: r.emoji == "📏", message.reactions) is not None:
+                await message.remove_reaction("📏", Object(self.client_id))
+            if bridge_record is None:
+                # we've never sent this message, possibly because it was too long
+                self.submit_send(message, self.journal_entry(kind="send", discord_message_id=message.id))
+            elif not self.can_modify(bridge_record.received_at):
+                await message.reply("Your edit was ignored because the edit window expired, sorry!")
             else:
-                se_message_id = await self.room.send(content)
-                await self.engine.save(BridgedMessage( # type: ignore
+                await self.scheduler.call(self.room.edit, bridge_record.se_message_id, new_content)
+
+    async def _send(self, message_id: int):
+        if (message := self._pending_sends.pop(message_id, None)) is None:
+            # deleted before we got to it
+            return
+        taken = [message]
+        try:
+            await self._send_message(message, taken)
+        except (OSError, ClientError):
+            # put back whatever we took, so the retry has something to send
+            for part in taken:
+                self._pending_sends.setdefault(part.id, part)
+            raise
+
+    async def _send_message(self, message: Message, taken: list[Message]):
+        content = await self.convert_content(message)
+        if self.should_batch() and self.can_batch(message, content):
+            # we're falling behind, so fold this author's queued messages into one
+            batch = [(message, content), *await self.collect_batch(message, content)]
+            taken.extend(part for part, _ in batch[1:])
+            if len(batch) > 1:
+                se_message_id = await self.scheduler.call(self.room.send, self.merge_contents(message.author, [content for _, content in batch]))
+                await self.records.save(BridgedMessage( # type: ignore
                     se_message_id=se_message_id,
                     discord_message_id=message.id,
+                    discord_guild_id=self.channel.guild.id,
+                    discord_channel_id=self.channel.id,
+                    merged_discord_message_ids=[part.id for part, _ in batch[1:]],
                     se_user_id=self.room.user_id,
                     discord_user_id=message.author.id,
                     received_at=datetime.now()
                 ))
-            self._send_queue.task_done()
-
-    async def _notification_task(self):
-        while True:
-            # give priority to user messages
-            await self._send_queue.join()
-            await self.room.send(*(await self.notification_queue.get()))
-    
+                for part, _ in batch:
+                    self.observe_sent(part)
+                return
+        content = await self.format_message(message, content)
+        if len(content) > self.max_message_length and content.count("\n") == 0:
+            await message.add_reaction("📏")
+        else:
+            se_message_id = await self.scheduler.call(self.room.send, content)
+            await self.records.save(BridgedMessage( # type: ignore
+                se_message_id=se_message_id,
+                discord_message_id=message.id,
+                discord_guild_id=self.channel.guild.id,
+                discord_channel_id=self.channel.id,
+                se_user_id=self.room.user_id,
+                discord_user_id=message.author.id,
+                received_at=datetime.now()
+            ))
+            self.observe_sent(message)
+
     async def _typing_task(self):
-        async with ClientSession() as session, session.ws_connect("wss://rydwolf.xyz/whos_typing") as connection:
+        async with self.http.ws_connect("wss://rydwolf.xyz/whos_typing", heartbeat=30) as connection:
             await connection.send_str(f"bridge\n{self.room.room_id}")
+            sent: list[str] | None = None
             while True:
-                async with self._typing_lock:
-                    now = datetime.now()
-                    names = []
-                    for id, last_typed in self._last_typed_at.items():
-                        if (now - last_typed).seconds <= 10:
-                            if (member := self.channel.guild.get_member(id)) is None:
-                                if (member := await self.channel.guild.fetch_member(id)) is None:
-                                    raise Exception(id)
-                            names.append(json.dumps(member.display_name))
+                await self._typing_changed.wait()
+                self._typing_changed.clear()
+                names = list(self._typing_names.values())
+                if names != sent:
                     if len(names):
-                        await connection.send_str("\n" + "\n".join(names))
+                        await connection.send_str("\n" + "\n".join(json.dumps(name) for name in names))
                     else:
                         await connection.send_str("")
-                await sleep(0.5)
-
-    async def _room_ws_task(self):
-        # open a webhook connection so we stay in the room list
-        async for event in self.room.events():
-            pass
+                    sent = names
 
     async def run(self):
         try:
             async with TaskGroup() as group:
-                group.create_task(self._delete_task(), name=f"delete/{self.room.room_id}")
-                group.create_task(self._edit_task(), name=f"edit/{self.room.room_id}")
-                group.create_task(self._send_task(), name=f"send/{self.room.room_id}")
-                group.create_task(self._notification_task(), name=f"notification/{self.room.room_id}")
+                group.create_task(self.scheduler.run(), name=f"scheduler/{self.room.room_id}")
                 group.create_task(self._typing_task(), name=f"typing/{self.room.room_id}")
-                group.create_task(self._room_ws_task(), name=f"room-ws-hack/{self.room.room_id}")
         finally:
             await self.room.close()
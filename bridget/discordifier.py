@@ -1,10 +1,16 @@
 from datetime import datetime
-from typing import TYPE_CHECKING, cast
-from urllib.parse import urlsplit, urlunsplit
+import html
+import re
+from time import perf_counter
+from typing import TYPE_CHECKING, TypeAlias, cast
+from urllib.parse import urlsplit
 
-from bs4 import Tag
+from bs4 import BeautifulSoup, Tag
 from discord import Embed
-from markdownify import MarkdownConverter, chomp
+from markdownify import MarkdownConverter, chomp, re_whitespace
+
+from bridget.metrics import conversion_time
+from bridget.util import fix_chat_url
 
 if TYPE_CHECKING:
     from bs4._typing import _AttributeValue  # type: ignore
@@ -24,20 +30,22 @@ class PatchedConverter(MarkdownConverter):
             return f"||{title}||"
         return super().convert_a(el, text, parent_tags)
 
+FastNode: TypeAlias = "str | tuple[str, dict[str, str], list[FastNode]]"
+
 class Discordifier:
+    # the tags plain single-line messages are made of
+    fast_tags = {"b", "i", "code", "a"}
+    fast_tag_re = re.compile(r"<(/?)([a-z]+)((?:\s+[a-z-]+=\"[^\"]*\")*)\s*>")
+    fast_attr_re = re.compile(r"([a-z-]+)=\"([^\"]*)\"")
+    fast_entity_re = re.compile(r"&(?!(?:amp|lt|gt|quot|apos|nbsp|#\d{1,5});)")
+
     def __init__(self):
         self.converter = PatchedConverter()
 
     @classmethod
     def fix_url(cls, url: "_AttributeValue"):
-        # Screw with URLs to make them work outside of a browser
         assert isinstance(url, str)
-        scheme, netloc, path, query, fragment = urlsplit(url)
-        if not scheme:
-            scheme = "https"
-        if not netloc:
-            netloc = "chat.stackexchange.com"
-        return urlunsplit((scheme, netloc, path, query, fragment))
+        return fix_chat_url(url)
 
     def convert_onebox(self, div: Tag):
         # welcome to assert hell, you may not leave
@@ -158,6 +166,86 @@ class Discordifier:
             a.attrs["href"] = self.fix_url(a.attrs["href"])
         return self.converter.process_tag(element)
 
+    def parse_fast(self, content: str) -> list[FastNode] | None:
+        # parse the common shapes of single-line message without building a soup,
+        # giving up (returning None) on anything we can't guarantee to handle
+        # exactly like lxml would
+        if not content or "\n" in content or "\r" in content or self.fast_entity_re.search(content):
+            return None
+        if not (content := content.lstrip(" \t")):
+            return None
+        root: list[FastNode] = []
+        stack: list[tuple[str, list[FastNode]]] = [("body", root)]
+        position = 0
+        for match in self.fast_tag_re.finditer(content):
+            text = content[position:match.start()]
+            if "<" in text:
+                return None
+            if text:
+                stack[-1][1].append(html.unescape(text))
+            position = match.end()
+            closing, name, attrs = match.groups()
+            if name not in self.fast_tags:
+                return None
+            if closing:
+                if attrs or stack[-1][0] != name:
+                    return None
+                stack.pop()
+            else:
+                if name == "a" and any(tag == "a" for tag, _ in stack):
+                    return None
+                parsed = dict(self.fast_attr_re.findall(attrs))
+                if name == "a" and "href" not in parsed:
+                    return None
+                children: list[FastNode] = []
+                stack[-1][1].append((name, {key: html.unescape(value) for key, value in parsed.items()}, children))
+                stack.append((name, children))
+        text = content[position:]
+        if "<" in text or len(stack) != 1:
+            return None
+        if text:
+            root.append(html.unescape(text))
+        return root
+
+    def render_fast(self, nodes: list[FastNode], parent_tags: set[str]) -> str:
+        # mirrors what MarkdownConverter.process_tag does for these inline tags
+        output = []
+        for node in nodes:
+            if isinstance(node, str):
+                text = re_whitespace.sub(" ", node)
+                if "_noformat" not in parent_tags:
+                    text = self.converter.escape(text, parent_tags)
+                output.append(text)
+            else:
+                name, attrs, children = node
+                if name == "a":
+                    attrs["href"] = self.fix_url(attrs["href"])
+                child_tags = parent_tags | {name}
+                if name == "code":
+                    child_tags.add("_noformat")
+                text = self.render_fast(children, child_tags)
+                output.append(self.converter.get_conv_fn_cached(name)(attrs, text, parent_tags=parent_tags))
+        return "".join(output)
+
+    def convert_fast(self, content: str):
+        started_at = perf_counter()
+        if (nodes := self.parse_fast(content)) is None:
+            return None
+        converted = self.render_fast(nodes, {"body"})
+        conversion_time.observe(perf_counter() - started_at, direction="se_to_discord", path="fast")
+        return converted
+
+    def convert_full(self, content: str):
+        started_at = perf_counter()
+        converted = self.convert(BeautifulSoup(content, features="lxml").body) # type: ignore
+        conversion_time.observe(perf_counter() - started_at, direction="se_to_discord", path="full")
+        return converted
+
+    def convert_html(self, content: str):
+        if (converted := self.convert_fast(content)) is not None:
+            return converted
+        return self.convert_full(content)
+
     def convert(self, body: Tag):
         if isinstance(div := body.find(class_="full", recursive=False), Tag):
             # multiline message
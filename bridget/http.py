@@ -0,0 +1,69 @@
+from contextlib import asynccontextmanager
+from time import monotonic
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from bridget.metrics import chat_http_latency
+
+CHAT_HOST = "https://chat.stackexchange.com"
+
+
+class ChatHTTP:
+    # one keep-alive connection pool shared by everything that talks to chat,
+    # so we don't pay for a TCP+TLS handshake on every slash command
+    def __init__(self, limit_per_host: int = 8, keepalive_timeout: float = 60, timeout: float = 10):
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = ClientTimeout(total=timeout)
+        self.requests = 0
+        self.failures = 0
+        self.total_latency = 0.0
+        self._session: ClientSession | None = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(limit_per_host=self.limit_per_host, keepalive_timeout=self.keepalive_timeout),
+            )
+        return self._session
+
+    @property
+    def average_latency(self):
+        if self.requests == 0:
+            return 0.0
+        return self.total_latency / self.requests
+
+    @asynccontextmanager
+    async def get(self, path: str):
+        url = path if path.startswith(("http://", "https://")) else CHAT_HOST + path
+        started_at = monotonic()
+        try:
+            async with self.session.get(url, timeout=self.timeout) as response:
+                yield response
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.requests += 1
+            self.total_latency += (latency := monotonic() - started_at)
+            chat_http_latency.observe(latency)
+
+    async def get_json(self, path: str):
+        async with self.get(path) as response:
+            return await response.json()
+
+    async def get_text(self, path: str):
+        async with self.get(path) as response:
+            return await response.text()
+
+    async def get_bytes(self, path: str):
+        async with self.get(path) as response:
+            return await response.read()
+
+    def ws_connect(self, url: str, **kwargs):
+        return self.session.ws_connect(url, **kwargs)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,100 @@
+from asyncio import CancelledError, Queue, Task, create_task, sleep
+from logging import getLogger
+from random import uniform
+from typing import Any
+
+from sechat import Room
+
+
+class RoomStream:
+    def __init__(self, room_id: int):
+        self.room_id = room_id
+        self.room: Room | None = None
+        self.subscribers: set[Queue[Any]] = set()
+        self.task: Task[None] | None = None
+        # consecutive failures, reset by this stream's own events only
+        self.failures = 0
+
+    def source(self):
+        # an authenticated connection keeps us in the room list, so prefer it
+        if self.room is not None:
+            return self.room.events()
+        return Room.anonymous(self.room_id)
+
+
+class RoomHub:
+    # one websocket per room, fanned out to everything that wants its events
+    def __init__(self, queue_size: int = 64, base_delay: float = 1, max_delay: float = 60):
+        self.queue_size = queue_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.logger = getLogger("RoomHub")
+        self._streams: dict[int, RoomStream] = {}
+
+    def _stream(self, room_id: int):
+        if room_id not in self._streams:
+            self._streams[room_id] = RoomStream(room_id)
+        return self._streams[room_id]
+
+    def _backoff(self, stream: RoomStream):
+        # the jitter keeps a chat outage from turning into a reconnect stampede
+        delay = min(self.base_delay * 2 ** stream.failures, self.max_delay)
+        return delay + uniform(0, delay / 2)
+
+    async def _pump(self, stream: RoomStream):
+        while True:
+            try:
+                async for event in stream.source():
+                    stream.failures = 0
+                    for queue in list(stream.subscribers):
+                        await queue.put(event)
+                self.logger.warning(f"Event stream for room {stream.room_id} ended, reconnecting")
+            except CancelledError:
+                raise
+            except Exception:
+                self.logger.exception(f"Event stream for room {stream.room_id} failed, reconnecting")
+            stream.failures += 1
+            await sleep(self._backoff(stream))
+
+    def _start(self, stream: RoomStream):
+        if stream.task is None or stream.task.done():
+            stream.task = create_task(self._pump(stream), name=f"room-events/{stream.room_id}")
+
+    def _stop(self, stream: RoomStream):
+        if stream.task is not None:
+            stream.task.cancel()
+            stream.task = None
+
+    def _restart(self, stream: RoomStream):
+        self._stop(stream)
+        if stream.room is not None or len(stream.subscribers):
+            self._start(stream)
+
+    def attach(self, room: Room):
+        # use an authenticated room as this room's event source
+        stream = self._stream(room.room_id)
+        stream.room = room
+        self._restart(stream)
+
+    def detach(self, room: Room):
+        stream = self._stream(room.room_id)
+        if stream.room is room:
+            stream.room = None
+            self._restart(stream)
+
+    async def events(self, room_id: int):
+        stream = self._stream(room_id)
+        queue: Queue[Any] = Queue(self.queue_size)
+        stream.subscribers.add(queue)
+        self._start(stream)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            stream.subscribers.discard(queue)
+            if stream.room is None and not len(stream.subscribers):
+                self._stop(stream)
+
+    def close(self):
+        for stream in self._streams.values():
+            self._stop(stream)
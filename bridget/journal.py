@@ -0,0 +1,153 @@
+from abc import ABC, abstractmethod
+from asyncio import Event, to_thread
+import json
+from logging import getLogger
+import os
+
+from bson import ObjectId
+from odmantic import AIOEngine
+
+from bridget.metrics import mongo_latency
+from bridget.models import JournalConfig, JournalEntry
+from bridget.util import flush_periodically
+
+
+class Journal(ABC):
+    # write-ahead log for DiscordToSEForwarder's work. appends and acks are
+    # buffered and written in batches; anything appended but never acked is
+    # replayed on the next startup
+    def __init__(self, flush_interval: float = 1, batch_size: int = 64):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.logger = getLogger(type(self).__name__)
+        self._appended: dict[ObjectId, JournalEntry] = {}
+        self._acked: set[ObjectId] = set()
+        self._writing_acked: set[ObjectId] = set()
+        self._flush_requested = Event()
+
+    def append(self, entry: JournalEntry):
+        self._appended[entry.id] = entry
+        if len(self._appended) >= self.batch_size:
+            self._flush_requested.set()
+        return entry
+
+    def ack(self, entry: JournalEntry):
+        # acked before it was ever written, so it never needs to be
+        if self._appended.pop(entry.id, None) is None:
+            self._acked.add(entry.id)
+            if len(self._acked) >= self.batch_size:
+                self._flush_requested.set()
+
+    async def flush(self):
+        appended, self._appended = list(self._appended.values()), {}
+        acked, self._acked = list(self._acked), set()
+        if not len(appended) and not len(acked):
+            return
+        self._writing_acked = set(acked)
+        try:
+            await self.write(appended, acked)
+        except Exception:
+            # keep it all for the next flush; anything acked meanwhile is in _acked already
+            self._appended = {entry.id: entry for entry in appended} | self._appended
+            self._acked.update(acked)
+            raise
+        finally:
+            self._writing_acked = set()
+
+    def unwritten(self, channel_id: int, stored: list[JournalEntry]):
+        # what pending() should say before the buffers reach storage: acked
+        # entries are done already, appended ones are still to do
+        acked = self._acked | self._writing_acked
+        stored_ids = {entry.id for entry in stored}
+        return [entry for entry in stored if entry.id not in acked] + [
+            entry for entry in self._appended.values()
+            if entry.channel_id == channel_id and entry.id not in stored_ids
+        ]
+
+    @abstractmethod
+    async def write(self, appended: list[JournalEntry], acked: list[ObjectId]):
+        ...
+
+    @abstractmethod
+    async def pending(self, channel_id: int) -> list[JournalEntry]:
+        ...
+
+    async def run(self):
+        await flush_periodically(self.flush, self._flush_requested, self.flush_interval, self.logger)
+
+
+class FileJournal(Journal):
+    def __init__(self, path: str, flush_interval: float = 1, batch_size: int = 64):
+        super().__init__(flush_interval, batch_size)
+        self.path = path
+        self._pending: dict[ObjectId, JournalEntry] = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if "add" in record:
+                        entry = JournalEntry.model_validate(record["add"])
+                        self._pending[entry.id] = entry
+                    else:
+                        self._pending.pop(ObjectId(record["ack"]), None)
+        except FileNotFoundError:
+            pass
+        # compact, so the file only grows with what's actually outstanding
+        with open(self.path + ".tmp", "w") as file:
+            for entry in self._pending.values():
+                file.write(json.dumps({"add": json.loads(entry.model_dump_json())}) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+
+    def append(self, entry: JournalEntry):
+        # so a bridge restarted in this process replays what its last run left over
+        self._pending[entry.id] = entry
+        return super().append(entry)
+
+    def ack(self, entry: JournalEntry):
+        self._pending.pop(entry.id, None)
+        super().ack(entry)
+
+    async def write(self, appended: list[JournalEntry], acked: list[ObjectId]):
+        # fsync can take a while, and everything else is waiting on the event loop
+        await to_thread(self._write, appended, acked)
+
+    def _write(self, appended: list[JournalEntry], acked: list[ObjectId]):
+        with open(self.path, "a") as file:
+            for entry in appended:
+                file.write(json.dumps({"add": json.loads(entry.model_dump_json())}) + "\n")
+            for id in acked:
+                file.write(json.dumps({"ack": str(id)}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    async def pending(self, channel_id: int):
+        return [entry for entry in self._pending.values() if entry.channel_id == channel_id]
+
+
+class MongoJournal(Journal):
+    def __init__(self, engine: AIOEngine, flush_interval: float = 1, batch_size: int = 64):
+        super().__init__(flush_interval, batch_size)
+        self.engine = engine
+
+    async def write(self, appended: list[JournalEntry], acked: list[ObjectId]):
+        with mongo_latency.time(operation="journal_write"):
+            if len(appended):
+                await self.engine.save_all(appended)
+            if len(acked):
+                await self.engine.remove(JournalEntry, JournalEntry.id.in_(acked))
+
+    async def pending(self, channel_id: int):
+        return self.unwritten(channel_id, await self.engine.find(JournalEntry, JournalEntry.channel_id == channel_id, sort=JournalEntry.created_at))
+
+
+def open_journal(config: JournalConfig, engine: AIOEngine) -> Journal:
+    match config["type"]:
+        case "file":
+            return FileJournal(config.get("path", "journal.jsonl"))
+        case "mongo":
+            return MongoJournal(engine)
@@ -0,0 +1,141 @@
+from asyncio import Event
+from bisect import bisect_left
+from contextlib import contextmanager
+from logging import getLogger
+from time import perf_counter
+from typing import Callable
+
+from aiohttp import web
+
+logger = getLogger("Metrics")
+
+Labels = tuple[tuple[str, str], ...]
+
+# seconds; covers everything from a cache hit to a badly ratelimited send
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def make_labels(labels: dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def format_labels(labels: Labels, extra: tuple[tuple[str, str], ...] = ()):
+    if not len(labels + extra):
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels + extra) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts: dict[Labels, list[int]] = {}
+        self.sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: object):
+        key = make_labels(labels)
+        if key not in self.counts:
+            self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0
+        self.counts[key][bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: object):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def count(self, **labels: object):
+        return sum(self.counts.get(make_labels(labels), ()))
+
+    def average(self, **labels: object):
+        if not (count := self.count(**labels)):
+            return 0.0
+        return self.sums[make_labels(labels)] / count
+
+    def quantile(self, q: float, **labels: object):
+        # upper bound of the bucket the quantile falls in, same as you'd get out of prometheus
+        if not (count := self.count(**labels)):
+            return 0.0
+        target = q * count
+        seen = 0
+        for bound, bucket_count in zip((*self.buckets, float("inf")), self.counts[make_labels(labels)]):
+            seen += bucket_count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, counts in self.counts.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                yield f"{self.name}_bucket{format_labels(labels, (('le', str(bound)),))} {total}"
+            yield f"{self.name}_sum{format_labels(labels)} {self.sums[labels]}"
+            yield f"{self.name}_count{format_labels(labels)} {total}"
+
+
+class Gauge:
+    # values are read when scraped, so nothing has to remember to update them
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.sources: dict[Labels, Callable[[], float]] = {}
+
+    def track(self, source: Callable[[], float], **labels: object):
+        self.sources[make_labels(labels)] = source
+
+    def untrack(self, **labels: object):
+        self.sources.pop(make_labels(labels), None)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, source in list(self.sources.items()):
+            try:
+                value = source()
+            except Exception:
+                logger.exception(f"Failed to read {self.name}{format_labels(labels)}")
+                continue
+            yield f"{self.name}{format_labels(labels)} {value}"
+
+
+se_to_discord_latency = Histogram("bridget_se_to_discord_seconds", "Time from receiving a chat event to delivering it to Discord")
+discord_to_se_latency = Histogram("bridget_discord_to_se_seconds", "Time from a Discord message being sent to it being posted in chat")
+conversion_time = Histogram("bridget_conversion_seconds", "Time spent converting messages between formats")
+mongo_latency = Histogram("bridget_mongo_seconds", "Latency of database calls")
+chat_http_latency = Histogram("bridget_chat_http_seconds", "Latency of requests to the chat server")
+cache_hits = Gauge("bridget_cache_hits", "Cache hits")
+cache_misses = Gauge("bridget_cache_misses", "Cache misses")
+queue_depth = Gauge("bridget_queue_depth", "Number of queued jobs")
+queue_age = Gauge("bridget_queue_oldest_seconds", "Age of the oldest queued job")
+
+# set the first time anything makes it across the bridge, for startup timing
+first_forward = Event()
+
+REGISTRY: list[Histogram | Gauge] = [
+    se_to_discord_latency, discord_to_se_latency, conversion_time, mongo_latency, chat_http_latency,
+    cache_hits, cache_misses, queue_depth, queue_age,
+]
+
+
+def render():
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+async def serve_metrics(host: str, port: int):
+    async def handle(request: web.Request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
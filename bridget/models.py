@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import TypedDict
+from typing import Any, Literal, NotRequired, TypedDict
 
 from odmantic import Field, Model
 
@@ -7,9 +7,44 @@ from odmantic import Field, Model
 class BridgedMessage(Model):
     se_message_id: int = Field(primary_field=True)
     discord_message_id: int = Field(unique=True, index=True)
-    se_user_id: int
-    discord_user_id: int
-    received_at: datetime
+    # the other discord messages that were batched into the same chat message, if any
+    merged_discord_message_ids: list[int] = Field(default=[], index=True)
+    # enough to link to the discord message without asking discord; missing on older records
+    discord_guild_id: int | None = None
+    discord_channel_id: int | None = None
+    # archived records only keep the ids above, see bridget.retention
+    se_user_id: int | None = None
+    discord_user_id: int | None = None
+    received_at: datetime | None = None
+
+class JournalEntry(Model):
+    # something DiscordToSEForwarder still has to do, kept until it's done
+    channel_id: int
+    kind: Literal["send", "edit", "delete", "notify"]
+    discord_message_id: int | None = None
+    text: str | None = None
+    se_message_id: int | None = None
+    created_at: datetime = Field(default_factory=datetime.now)
+
+    model_config = {"collection": "journal"}
+
+class BridgeLease(Model):
+    # which worker runs a bridge, see bridget.sharding. workers hold a "worker/<name>" lease too
+    key: str = Field(primary_field=True)
+    owner: str
+    expires_at: datetime
+    # on worker leases, the gateway shard whose bridges that worker can run
+    group: str | None = None
+
+    model_config = {"collection": "leases"}
+
+class CachedWebhook(Model):
+    # what a bridge's webhook resolved to last time, so startup doesn't have to ask discord again.
+    # see util.webhook_payload
+    key: str = Field(primary_field=True)
+    payload: dict[str, Any]
+
+    model_config = {"collection": "webhooks"}
 
 class DualBridge(TypedDict):
     channel: int
@@ -27,6 +62,38 @@ class DatabaseConfig(TypedDict):
     uri: str
     name: str
 
+class JournalConfig(TypedDict):
+    # "file" for an append-only file at `path`, "mongo" for a collection in the bridge database
+    type: Literal["file", "mongo"]
+    path: NotRequired[str]
+
+class RetentionConfig(TypedDict):
+    # "delete" drops records entirely after `days`, "archive" strips them down to the id pair
+    mode: Literal["delete", "archive"]
+    days: int
+
+class MetricsConfig(TypedDict):
+    host: NotRequired[str]
+    port: int
+
+class ShardingConfig(TypedDict):
+    # must be unique across every host; defaults to hostname/pid
+    worker: NotRequired[str]
+    # worker processes to start on this host
+    processes: NotRequired[int]
+    maxBridges: NotRequired[int]
+    leaseSeconds: NotRequired[int]
+    # gateway sharding; processes on this host take consecutive shard ids from firstShard
+    shardCount: NotRequired[int]
+    firstShard: NotRequired[int]
+
+class ConversionConfig(TypedDict):
+    executor: Literal["inline", "thread", "process"]
+    workers: NotRequired[int]
+    queueSize: NotRequired[int]
+    # messages shorter than this are converted inline
+    inlineBelow: NotRequired[int]
+
 class ChatConfig(TypedDict):
     email: str
     password: str
@@ -36,4 +103,12 @@ class Configuration(TypedDict):
     chat: ChatConfig
     database: DatabaseConfig
     dual: list[DualBridge]
-    single: list[SingleBridge]
\ No newline at end of file
+    single: list[SingleBridge]
+    pfpCache: NotRequired[str]
+    pipelineDepth: NotRequired[int]
+    journal: NotRequired[JournalConfig]
+    retention: NotRequired[RetentionConfig]
+    metrics: NotRequired[MetricsConfig]
+    sharding: NotRequired[ShardingConfig]
+    conversion: NotRequired[ConversionConfig]
+    startupConcurrency: NotRequired[int]
\ No newline at end of file
@@ -0,0 +1,155 @@
+from asyncio import Event, Lock
+from logging import getLogger
+from typing import Callable
+
+from odmantic import AIOEngine, query
+from pymongo import DeleteMany, ReplaceOne
+
+from bridget.metrics import mongo_latency
+from bridget.models import BridgedMessage
+from bridget.util import TTLCache, flush_periodically
+
+
+class BridgeRecords:
+    # almost every lookup is for a message from the last few minutes,
+    # so keep recent records around instead of asking mongo every time.
+    # writes are buffered and flushed in bulk; lookups see them straight away
+    def __init__(self, engine: AIOEngine, maxsize: int = 4096, ttl: float = 60 * 30, flush_interval: float = 1, batch_size: int = 100):
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.flushes = 0
+        self.logger = getLogger("BridgeRecords")
+        self._by_se_id: TTLCache[int, BridgedMessage] = TTLCache(maxsize, ttl)
+        self._by_discord_id: TTLCache[int, BridgedMessage] = TTLCache(maxsize, ttl)
+        self._pending_saves: dict[int, BridgedMessage] = {}
+        self._pending_by_discord_id: dict[int, BridgedMessage] = {}
+        self._pending_deletes: set[int] = set()
+        self._flush_requested = Event()
+        # one flush at a time, so "flushed" means everything before it is written
+        self._flush_lock = Lock()
+        self._after_flush: list[Callable[[], None]] = []
+
+    @property
+    def hits(self):
+        return self._by_se_id.hits + self._by_discord_id.hits
+
+    @property
+    def misses(self):
+        return self._by_se_id.misses + self._by_discord_id.misses
+
+    @property
+    def pending(self):
+        return len(self._pending_saves) + len(self._pending_deletes)
+
+    def remember(self, record: BridgedMessage):
+        self._by_se_id.put(record.se_message_id, record)
+        for discord_message_id in (record.discord_message_id, *record.merged_discord_message_ids):
+            self._by_discord_id.put(discord_message_id, record)
+
+    def forget(self, record: BridgedMessage):
+        self._by_se_id.pop(record.se_message_id)
+        for discord_message_id in (record.discord_message_id, *record.merged_discord_message_ids):
+            self._by_discord_id.pop(discord_message_id)
+            self._pending_by_discord_id.pop(discord_message_id, None)
+
+    async def by_se_id(self, se_message_id: int):
+        if se_message_id in self._pending_deletes:
+            return None
+        if (record := self._pending_saves.get(se_message_id)) is not None:
+            return record
+        if (record := self._by_se_id.get(se_message_id)) is None:
+            with mongo_latency.time(operation="find"):
+                record = await self.engine.find_one(BridgedMessage, BridgedMessage.se_message_id == se_message_id)
+            if record is not None:
+                self.remember(record)
+        return record
+
+    async def by_discord_id(self, discord_message_id: int):
+        if (record := self._pending_by_discord_id.get(discord_message_id)) is not None:
+            return record
+        if (record := self._by_discord_id.get(discord_message_id)) is None:
+            with mongo_latency.time(operation="find"):
+                record = await self.engine.find_one(BridgedMessage, query.or_(
+                    BridgedMessage.discord_message_id == discord_message_id,
+                    BridgedMessage.merged_discord_message_ids == discord_message_id,
+                ))
+            if record is not None:
+                self.remember(record)
+        if record is not None and record.se_message_id in self._pending_deletes:
+            return None
+        return record
+
+    def _request_flush(self):
+        if self.pending >= self.batch_size:
+            self._flush_requested.set()
+
+    def _buffer_save(self, record: BridgedMessage):
+        self._pending_deletes.discard(record.se_message_id)
+        self._pending_saves[record.se_message_id] = record
+        for discord_message_id in (record.discord_message_id, *record.merged_discord_message_ids):
+            self._pending_by_discord_id[discord_message_id] = record
+
+    async def save(self, record: BridgedMessage):
+        self.remember(record)
+        self._buffer_save(record)
+        if self.pending >= self.batch_size * 10:
+            # mongo isn't keeping up, so slow the callers down
+            try:
+                await self.flush()
+            except Exception:
+                # still buffered, and run() keeps retrying; the send itself went through
+                self.logger.exception("Backpressure flush failed")
+        self._request_flush()
+        return record
+
+    async def delete(self, record: BridgedMessage):
+        self.forget(record)
+        self._pending_saves.pop(record.se_message_id, None)
+        self._pending_deletes.add(record.se_message_id)
+        self._request_flush()
+
+    def after_flush(self, callback: Callable[[], None]):
+        # call back once everything buffered so far is in the database
+        if not self.pending and not self._flush_lock.locked():
+            callback()
+        else:
+            self._after_flush.append(callback)
+
+    async def flush(self):
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        callbacks, self._after_flush = self._after_flush, []
+        saves, self._pending_saves, self._pending_by_discord_id = list(self._pending_saves.values()), {}, {}
+        deletes, self._pending_deletes = list(self._pending_deletes), set()
+        operations: list[ReplaceOne | DeleteMany] = [
+            ReplaceOne({"_id": record.se_message_id}, record.model_dump_doc(), upsert=True)
+            for record in saves
+        ]
+        if len(deletes):
+            operations.append(DeleteMany({"_id": {"$in": deletes}}))
+        if not len(operations):
+            for callback in callbacks:
+                callback()
+            return
+        try:
+            with mongo_latency.time(operation="bulk_write"):
+                await self.engine.get_collection(BridgedMessage).bulk_write(operations, ordered=False)
+        except Exception:
+            # put back whatever hasn't been superseded in the meantime, so the next flush retries it
+            for record in saves:
+                if record.se_message_id not in self._pending_saves and record.se_message_id not in self._pending_deletes:
+                    self._buffer_save(record)
+            for se_message_id in deletes:
+                if se_message_id not in self._pending_saves:
+                    self._pending_deletes.add(se_message_id)
+            self._after_flush = callbacks + self._after_flush
+            raise
+        self.flushes += 1
+        for callback in callbacks:
+            callback()
+
+    async def run(self):
+        await flush_periodically(self.flush, self._flush_requested, self.flush_interval, self.logger)
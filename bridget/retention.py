@@ -0,0 +1,56 @@
+from asyncio import sleep
+from datetime import datetime, timedelta
+from logging import getLogger
+
+from odmantic import AIOEngine
+from pymongo.errors import OperationFailure
+
+from bridget.models import BridgedMessage, CachedWebhook, JournalEntry, RetentionConfig
+from bridget.util import DAY, HOUR
+
+logger = getLogger("Retention")
+
+ARCHIVED_FIELDS = ("se_user_id", "discord_user_id", "received_at")
+
+
+async def migrate(engine: AIOEngine, retention: RetentionConfig | None):
+    # indexes for every lookup we do: _id is the SE id, discord_message_id and
+    # merged_discord_message_ids come from the model, received_at depends on the retention mode
+    await engine.configure_database([BridgedMessage, JournalEntry], update_existing_indexes=True)
+    collection = engine.get_collection(BridgedMessage)
+    options = {}
+    if retention is not None and retention["mode"] == "delete":
+        options["expireAfterSeconds"] = retention["days"] * DAY
+    existing = (await collection.index_information()).get("received_at_1")
+    if existing is not None and existing.get("expireAfterSeconds") != options.get("expireAfterSeconds"):
+        logger.info("Retention settings changed, rebuilding received_at index")
+        await collection.drop_index("received_at_1")
+    try:
+        await collection.create_index("received_at", **options)
+    except OperationFailure:
+        logger.exception("Failed to create received_at index")
+        raise
+    # records from before batching don't have the field at all
+    await collection.update_many({"merged_discord_message_ids": {"$exists": False}}, {"$set": {"merged_discord_message_ids": []}})
+    # webhooks used to be cached along with their tokens
+    await engine.get_collection(CachedWebhook).update_many({"payload.token": {"$exists": True}}, {"$unset": {"payload.token": ""}})
+
+
+async def archive(engine: AIOEngine, days: int):
+    # past the edit window only the id pair is ever needed again, for replies and permalinks
+    collection = engine.get_collection(BridgedMessage)
+    result = await collection.update_many(
+        {"received_at": {"$lt": datetime.now() - timedelta(days=days)}},
+        {"$unset": {field: "" for field in ARCHIVED_FIELDS}},
+    )
+    return result.modified_count
+
+
+async def run_retention(engine: AIOEngine, retention: RetentionConfig, interval: float = HOUR):
+    # "delete" is handled by mongo itself through the TTL index
+    if retention["mode"] != "archive":
+        return
+    while True:
+        if archived := await archive(engine, retention["days"]):
+            logger.info(f"Archived {archived} bridge records")
+        await sleep(interval)
@@ -0,0 +1,144 @@
+from asyncio import Event, sleep
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+from logging import getLogger
+import re
+from time import monotonic
+from typing import Awaitable, Callable, ParamSpec, TypeVar
+
+from sechat.errors import OperationFailedError
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+THROTTLE_RE = re.compile(r"again in (\d+) seconds?")
+
+
+class Priority(IntEnum):
+    # edits and deletes are only possible for a couple of minutes, so they go first
+    MODIFY = 0
+    SEND = 1
+    NOTIFY = 2
+
+
+class TokenBucket:
+    # chat doesn't tell us its limit up front, so start optimistic, back off
+    # multiplicatively when throttled and creep back up while things go through
+    def __init__(self, rate: float = 1, burst: float = 4, min_rate: float = 0.1, max_rate: float = 2):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.throttles = 0
+        self._tokens = burst
+        self._updated_at = monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        while True:
+            if (blocked := self._blocked_until - monotonic()) > 0:
+                await sleep(blocked)
+                continue
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await sleep((1 - self._tokens) / self.rate)
+
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + 0.01)
+
+    def throttled(self, retry_after: float):
+        self.throttles += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = 0
+        self._blocked_until = max(self._blocked_until, monotonic() + retry_after)
+
+
+@dataclass
+class Job:
+    priority: Priority
+    key: int
+    run: Callable[[], Awaitable[None]]
+    enqueued_at: float = field(default_factory=monotonic)
+
+
+class ChatScheduler:
+    def __init__(self, bucket: TokenBucket | None = None, max_retries: int = 3):
+        self.bucket = bucket if bucket is not None else TokenBucket()
+        self.max_retries = max_retries
+        self.logger = getLogger("ChatScheduler")
+        self.completed = {priority: 0 for priority in Priority}
+        self.total_wait = {priority: 0.0 for priority in Priority}
+        self.failed = {priority: 0 for priority in Priority}
+        # per priority, a round-robin of per-user queues so one flooder can't starve everyone else
+        self._queues: dict[Priority, OrderedDict[int, deque[Job]]] = {priority: OrderedDict() for priority in Priority}
+        self._wakeup = Event()
+
+    def submit(self, priority: Priority, key: int, run: Callable[[], Awaitable[None]]):
+        job = Job(priority, key, run)
+        self._queues[priority].setdefault(key, deque()).append(job)
+        self._wakeup.set()
+        return job
+
+    def depth(self, priority: Priority):
+        return sum(len(jobs) for jobs in self._queues[priority].values())
+
+    def oldest_age(self, priority: Priority):
+        now = monotonic()
+        return max((now - jobs[0].enqueued_at for jobs in self._queues[priority].values()), default=0.0)
+
+    def average_wait(self, priority: Priority):
+        if self.completed[priority] == 0:
+            return 0.0
+        return self.total_wait[priority] / self.completed[priority]
+
+    def _next(self):
+        for priority in Priority:
+            queues = self._queues[priority]
+            if not len(queues):
+                continue
+            key, jobs = queues.popitem(last=False)
+            job = jobs.popleft()
+            if len(jobs):
+                queues[key] = jobs
+            return job
+        return None
+
+    async def call(self, fn: Callable[P, Awaitable[T]], *args: P.args, **kwargs: P.kwargs) -> T:
+        # run a rate-limited chat operation, learning from any throttling
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                result = await fn(*args, **kwargs)
+            except OperationFailedError as e:
+                if (match := THROTTLE_RE.search(str(e))) is None or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.bucket.throttled(int(match[1]))
+                self.logger.info(f"Throttled by chat, retrying in {match[1]}s (rate now {self.bucket.rate:.2f}/s)")
+            else:
+                self.bucket.succeeded()
+                return result
+
+    async def run(self):
+        while True:
+            if (job := self._next()) is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self.completed[job.priority] += 1
+            self.total_wait[job.priority] += monotonic() - job.enqueued_at
+            try:
+                await job.run()
+            except Exception:
+                # one bad message shouldn't hold up everything queued behind it
+                self.failed[job.priority] += 1
+                self.logger.exception(f"{job.priority.name.lower()} job for {job.key} failed")
@@ -1,61 +1,97 @@
+from asyncio import Event, Queue, Task, TaskGroup
 import re
 from datetime import datetime
+from logging import getLogger
+from time import monotonic
 
-from bs4 import BeautifulSoup
-from discord import (Embed, Forbidden, NotFound, TextChannel, Webhook,
-                     WebhookMessage)
+from discord import Embed, Forbidden, NotFound, TextChannel, Webhook
 from discord.utils import MISSING
-from odmantic import AIOEngine
-from sechat import Room
 from sechat.events import DeleteEvent, EditEvent, MessageEvent
 
-from bridget.discordifier import Discordifier
+from bridget.conversion import ConversionPool
+from bridget.http import ChatHTTP
+from bridget.hub import RoomHub
+from bridget.metrics import first_forward, se_to_discord_latency
 from bridget.models import BridgedMessage
-from bridget.util import ChatPFPFetcher
+from bridget.records import BridgeRecords
+from bridget.util import ChatPFPFetcher, TTLCache
+
+Prepared = tuple[str, list[Embed], str]
 
 
 class SEToDiscordForwarder:
-    pfp_fetcher = ChatPFPFetcher()
-    converter = Discordifier()
-    
-    def __init__(self, room_id: int, ignored: list[int], suppress_embeds_for: list[int], webhook: Webhook, engine: AIOEngine):
+    def __init__(self, room_id: int, ignored: list[int], suppress_embeds_for: list[int], webhook: Webhook, hub: RoomHub, records: BridgeRecords, http: ChatHTTP, pfp_fetcher: ChatPFPFetcher, concurrency: int = 8, reply_cache_size: int = 2048, conversions: ConversionPool | None = None):
         self.ignored = ignored
         self.room_id = room_id
         self.suppress_embeds_for = suppress_embeds_for
         self.webhook = webhook
-        self.engine = engine
+        self.hub = hub
+        self.records = records
+        self.http = http
+        self.pfp_fetcher = pfp_fetcher
+        self.conversions = conversions if conversions is not None else ConversionPool()
+        self.logger = getLogger("SEToDiscordForwarder")
+
+        self._pipeline: Queue[tuple[MessageEvent | DeleteEvent, Task[Prepared | None] | None, float]] = Queue(concurrency)
+        self._pending_sends: dict[int, Event] = {}
+        # first line of every message we've seen go by, for reply embeds
+        self.reply_texts: TTLCache[int, str] = TTLCache(reply_cache_size)
 
     async def fetch_corresponding_message(self, se_message_id: int):
-        if (message := await self.engine.find_one(BridgedMessage, BridgedMessage.se_message_id == se_message_id)) is not None:
+        if (message := await self.records.by_se_id(se_message_id)) is not None:
             try:
                 assert self.webhook.user is not None
                 if message.discord_user_id == self.webhook.user.id:
                     return await self.webhook.fetch_message(message.discord_message_id)
-                else:
-                    assert isinstance(self.webhook.channel, TextChannel)
+                elif isinstance(self.webhook.channel, TextChannel):
                     return await self.webhook.channel.fetch_message(message.discord_message_id)
+                # a one-way bridge into a guild outside our gateway shard can't see the channel
+                return None
             except (NotFound, Forbidden) as e:
                 return None
 
-    async def create_reply_embed(self, messageId: int):
-        async with self.webhook.session.get(f"https://chat.stackexchange.com/message/{messageId}?raw=true") as response:
-            return Embed(
-                title=f"Reply to #{messageId}",
-                url=f"https://chat.stackexchange.com/transcript/message/{messageId}#{messageId}",
-                description=(await response.text()).splitlines()[0]
-            )
+    async def webhook_message_id(self, se_message_id: int):
+        # the discord id of our copy of a message, if we're the one who can modify it.
+        # archived records don't know the author, so just try and let discord say no
+        assert self.webhook.user is not None
+        if (record := await self.records.by_se_id(se_message_id)) is None:
+            return None
+        if record.discord_user_id is not None and record.discord_user_id != self.webhook.user.id:
+            return None
+        return record.discord_message_id
 
-    async def handle_message(self, event: MessageEvent):
+    def reply_prefix(self, record: BridgedMessage):
+        # everything a reply needs is in the record, unless it predates guild/channel ids
+        # or has been archived
         assert self.webhook.user is not None
+        if record.discord_guild_id is None or record.discord_channel_id is None or record.discord_user_id is None:
+            return None
+        prefix = f"[⤷](https://discord.com/channels/{record.discord_guild_id}/{record.discord_channel_id}/{record.discord_message_id}) "
+        if record.discord_user_id != self.webhook.user.id:
+            prefix += f"<@{record.discord_user_id}> "
+        return prefix
+
+    async def fetch_reply_text(self, messageId: int):
+        return next(iter((await self.http.get_text(f"/message/{messageId}?raw=true")).splitlines()), "")
+
+    async def create_reply_embed(self, messageId: int):
+        return Embed(
+            title=f"Reply to #{messageId}",
+            url=f"https://chat.stackexchange.com/transcript/message/{messageId}#{messageId}",
+            description=await self.reply_texts.fetch(messageId, self.fetch_reply_text)
+        )
+
+    async def prepare_message(self, event: MessageEvent) -> Prepared | None:
+        # everything that doesn't depend on delivery order; runs concurrently
         if event.user_id in self.ignored:
-            return
+            return None
         if event.content.startswith("\u200d"):
-            return
+            return None
         if event.user_name in ("everyone", "here"):
-            return
-        converted = self.converter.convert(BeautifulSoup(event.content, features="lxml").body) # type: ignore
+            return None
+        converted = await self.conversions.convert_html(event.content)
         if converted is None:
-            return
+            return None
         pfp = await self.pfp_fetcher.fetch_pfp_url(event.user_id)
         # this isn't great
         if isinstance(converted, Embed):
@@ -64,24 +100,37 @@ class SEToDiscordForwarder:
         else:
             embeds = []
             content = converted
-        view = MISSING
+            self.reply_texts.put(event.message_id, next(iter(content.splitlines()), ""))
         if event.parent_id is not None and event.show_parent:
             content = re.sub(r"^@\S+", "", content).strip()
-            if (replied_message := await self.fetch_corresponding_message(event.parent_id)) is not None:
+            if (pending := self._pending_sends.get(event.parent_id)) is not None:
+                # the parent is still in the pipeline, wait for it to land
+                await pending.wait()
+            if (record := await self.records.by_se_id(event.parent_id)) is not None and (prefix := self.reply_prefix(record)) is not None:
+                content = prefix + content
+            elif (replied_message := await self.fetch_corresponding_message(event.parent_id)) is not None:
                 prefix = f"[⤷]({replied_message.jump_url}) "
                 if replied_message.author.id != self.webhook.id:
                     prefix += f"{replied_message.author.mention} "
                 content = prefix + content
             else:
                 embeds.append(await self.create_reply_embed(event.parent_id))
+        return content, embeds, pfp
+
+    async def deliver_message(self, event: MessageEvent, content: str, embeds: list[Embed], pfp: str):
+        assert self.webhook.user is not None
+        view = MISSING
         if isinstance(event, EditEvent):
-            message = await self.fetch_corresponding_message(event.message_id)
-            if isinstance(message, WebhookMessage):
-                await message.edit(
-                    content=content,
-                    embeds=embeds,
-                    view=view
-                )
+            if (message_id := await self.webhook_message_id(event.message_id)) is not None:
+                try:
+                    await self.webhook.edit_message(
+                        message_id,
+                        content=content,
+                        embeds=embeds,
+                        view=view
+                    )
+                except (NotFound, Forbidden):
+                    pass
         else:
             message = await self.webhook.send(
                 content=content,
@@ -92,23 +141,70 @@ class SEToDiscordForwarder:
                 view=view,
                 wait=True,
             )
-            await self.engine.save(BridgedMessage( # type: ignore
+            record = BridgedMessage( # type: ignore
                 se_message_id=event.message_id,
                 discord_message_id=message.id,
+                discord_guild_id=self.webhook.guild_id,
+                discord_channel_id=self.webhook.channel_id,
                 se_user_id=event.user_id,
                 discord_user_id=self.webhook.user.id,
                 received_at=datetime.now()
-            ))
+            )
+            # only buffered, the actual write happens off the critical path
+            await self.records.save(record)
+
+    async def handle_message(self, event: MessageEvent):
+        if (prepared := await self.prepare_message(event)) is not None:
+            await self.deliver_message(event, *prepared)
 
     async def handle_delete(self, event: DeleteEvent):
+        self.reply_texts.pop(event.message_id)
         if event.user_id in self.ignored:
             return
-        if isinstance(message := await self.fetch_corresponding_message(event.message_id), WebhookMessage):
-            await message.delete()
+        if (message_id := await self.webhook_message_id(event.message_id)) is not None:
+            try:
+                await self.webhook.delete_message(message_id)
+            except (NotFound, Forbidden):
+                pass
+
+    async def _prepare_task(self, event: MessageEvent):
+        # these run in the same task group as delivery, so a failure here would take it down
+        try:
+            return await self.prepare_message(event)
+        except Exception:
+            self.logger.exception(f"Failed to prepare message {event.message_id} in room {self.room_id}")
+            return None
+
+    async def _deliver_task(self):
+        # delivery is strictly in stream order, even though preparation isn't
+        while True:
+            event, prepared, received_at = await self._pipeline.get()
+            try:
+                if isinstance(event, MessageEvent):
+                    assert prepared is not None
+                    if (result := await prepared) is not None:
+                        await self.deliver_message(event, *result)
+                        se_to_discord_latency.observe(monotonic() - received_at, room=self.room_id, kind="edit" if isinstance(event, EditEvent) else "send")
+                        first_forward.set()
+                elif isinstance(event, DeleteEvent):
+                    await self.handle_delete(event)
+                    se_to_discord_latency.observe(monotonic() - received_at, room=self.room_id, kind="delete")
+            except Exception:
+                # one bad event shouldn't stop everything behind it
+                self.logger.exception(f"Failed to forward event for message {event.message_id} in room {self.room_id}")
+            finally:
+                if (pending := self._pending_sends.pop(event.message_id, None)) is not None:
+                    pending.set()
+                self._pipeline.task_done()
 
     async def run(self):
-        async for event in Room.anonymous(self.room_id):
-            if isinstance(event, MessageEvent):
-                await self.handle_message(event)
-            elif isinstance(event, DeleteEvent):
-                await self.handle_delete(event)
\ No newline at end of file
+        async with TaskGroup() as group:
+            group.create_task(self._deliver_task(), name=f"deliver/{self.room_id}")
+            async for event in self.hub.events(self.room_id):
+                # blocks once `concurrency` events are waiting to be delivered
+                if isinstance(event, MessageEvent):
+                    if not isinstance(event, EditEvent):
+                        self._pending_sends[event.message_id] = Event()
+                    await self._pipeline.put((event, group.create_task(self._prepare_task(event)), monotonic()))
+                elif isinstance(event, DeleteEvent):
+                    await self._pipeline.put((event, None, monotonic()))
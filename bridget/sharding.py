@@ -0,0 +1,192 @@
+from asyncio import CancelledError, Task, create_task, gather, sleep
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
+from math import ceil
+from random import shuffle
+import re
+from time import monotonic
+from typing import Awaitable, Callable
+
+from odmantic import AIOEngine
+from pymongo.errors import DuplicateKeyError
+
+from bridget.models import BridgeLease, DualBridge, SingleBridge
+
+WEBHOOK_ID_RE = re.compile(r"/webhooks/(\d+)/")
+
+
+def dual_key(config: DualBridge):
+    return f"dual/{config['channel']}"
+
+def single_key(config: SingleBridge):
+    # only the webhook id, the url has the token in it (see util.webhook_payload)
+    if (match := WEBHOOK_ID_RE.search(config["hook"])) is not None:
+        return f"single/{config['room']}/{match[1]}"
+    return f"single/{config['room']}"
+
+
+class LeaseCoordinator:
+    # every worker runs one of these against the same collection. a bridge runs
+    # wherever holds its lease; leases are renewed every `interval` and expire
+    # after `lease_time`, so a dead worker's bridges get picked up by the rest.
+    # live workers are counted through their own heartbeat leases so each one
+    # only takes its fair share. with gateway sharding, bridges in `restricted`
+    # can only run on workers in the same `group` (shard), so those are shared
+    # out among that group alone
+    def __init__(self, engine: AIOEngine, worker: str, lease_time: float = 30, interval: float = 10, max_bridges: int | None = None, group: str | None = None):
+        self.engine = engine
+        self.worker = worker
+        self.group = group
+        self.lease_time = lease_time
+        self.interval = interval
+        self.max_bridges = max_bridges
+        self.logger = getLogger("LeaseCoordinator")
+        self.collection = engine.get_collection(BridgeLease)
+        self.bridges: dict[str, Callable[[], Awaitable[None]]] = {}
+        self.restricted: set[str] = set()
+        self._tasks: dict[str, Task[None]] = {}
+        self._renewed_at = monotonic()
+
+    @property
+    def heartbeat_key(self):
+        return f"worker/{self.worker}"
+
+    @property
+    def owned(self):
+        return list(self._tasks)
+
+    async def acquire(self, key: str, **fields: object):
+        now = datetime.now(timezone.utc)
+        try:
+            await self.collection.update_one(
+                {"_id": key, "$or": [{"owner": self.worker}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.worker, "expires_at": now + timedelta(seconds=self.lease_time), **fields}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # somebody else holds it and it hasn't expired
+            return False
+        return True
+
+    async def release(self, key: str):
+        await self.collection.delete_one({"_id": key, "owner": self.worker})
+
+    async def renew(self):
+        # returns whichever of our leases we still hold. the expiry is worked out
+        # from before the call, in case it takes a while
+        renewed_at = monotonic()
+        now = datetime.now(timezone.utc)
+        keys = [self.heartbeat_key, *self._tasks]
+        await self.collection.update_many(
+            {"_id": {"$in": keys}, "owner": self.worker},
+            {"$set": {"expires_at": now + timedelta(seconds=self.lease_time)}},
+        )
+        held = {document["_id"] async for document in self.collection.find({"_id": {"$in": keys}, "owner": self.worker}, {"_id": True})}
+        if self.heartbeat_key not in held:
+            await self.acquire(self.heartbeat_key, group=self.group)
+        self._renewed_at = renewed_at
+        return held
+
+    async def live_workers(self, group: str | None = None):
+        filter: dict[str, object] = {
+            "_id": {"$regex": "^worker/"},
+            "expires_at": {"$gt": datetime.now(timezone.utc)},
+        }
+        if group is not None:
+            filter["group"] = group
+        return await self.collection.count_documents(filter)
+
+    def expiring(self):
+        # stop a little before anyone else could take our leases over
+        return monotonic() - self._renewed_at > self.lease_time - min(self.interval, self.lease_time / 3)
+
+    async def watchdog(self):
+        # apart from balance(), so a mongo call that hangs can't leave bridges
+        # running here after another worker has taken them over
+        while True:
+            await sleep(min(1, self.interval / 2))
+            if len(self._tasks) and self.expiring():
+                self.logger.warning("Couldn't renew leases in time, stopping every bridge")
+                for key in self.owned:
+                    await self.stop(key, release=False)
+
+    async def _run_bridge(self, key: str, run: Callable[[], Awaitable[None]]):
+        try:
+            await run()
+        except CancelledError:
+            raise
+        except Exception:
+            # give it up; whoever gets the lease next (maybe us) will try again
+            self.logger.exception(f"Bridge {key} crashed")
+
+    def start(self, key: str, run: Callable[[], Awaitable[None]]):
+        self.logger.info(f"Acquired {key}")
+        self._tasks[key] = create_task(self._run_bridge(key, run), name=key)
+
+    async def stop(self, key: str, release: bool = True):
+        if (task := self._tasks.pop(key, None)) is not None:
+            task.cancel()
+            await gather(task, return_exceptions=True)
+        if release:
+            await self.release(key)
+
+    async def update(self, bridges: dict[str, Callable[[], Awaitable[None]]], restricted: set[str] = set(), restart: set[str] = set()):
+        # after a config reload; whatever we stop here gets picked up again by
+        # the next balance, possibly on a different worker
+        self.bridges = bridges
+        self.restricted = restricted
+        for key in self.owned:
+            if key not in bridges or key in restart:
+                self.logger.info(f"Stopping {key} for reconfiguration")
+                await self.stop(key)
+
+    async def balance(self):
+        bridges = self.bridges
+        held = await self.renew()
+        for key in self.owned:
+            if key not in held:
+                self.logger.warning(f"Lost the lease for {key}, stopping it")
+                await self.stop(key, release=False)
+            elif self._tasks[key].done():
+                await self.stop(key)
+        if self.expiring():
+            return
+        # bridges any worker can run are shared between all of them, restricted
+        # ones only between the workers that can run them
+        for restricted, workers in ((False, await self.live_workers()), (True, await self.live_workers(self.group))):
+            keys = [key for key in bridges if (key in self.restricted) == restricted]
+            owned = [key for key in self.owned if (key in self.restricted) == restricted]
+            share = ceil(len(keys) / max(1, workers))
+            if self.max_bridges is not None:
+                share = max(0, min(share, self.max_bridges - (len(self._tasks) - len(owned))))
+            # more workers showed up than last time, so hand some bridges over
+            for key in owned[share:]:
+                self.logger.info(f"Handing over {key}")
+                await self.stop(key)
+            candidates = [key for key in keys if key not in self._tasks]
+            shuffle(candidates)
+            for key in candidates:
+                if len(owned) >= share:
+                    break
+                if await self.acquire(key):
+                    self.start(key, bridges[key])
+                    owned.append(key)
+
+    async def run(self, bridges: dict[str, Callable[[], Awaitable[None]]], restricted: set[str] = set()):
+        self.bridges = bridges
+        self.restricted = restricted
+        await self.acquire(self.heartbeat_key, group=self.group)
+        self._renewed_at = monotonic()
+        watchdog = create_task(self.watchdog())
+        try:
+            while True:
+                try:
+                    await self.balance()
+                except Exception:
+                    self.logger.exception("Failed to update leases")
+                await sleep(self.interval)
+        finally:
+            watchdog.cancel()
+            for key in self.owned:
+                await self.stop(key, release=False)
+            await self.collection.delete_many({"owner": self.worker})
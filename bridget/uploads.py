@@ -0,0 +1,50 @@
+from asyncio import Condition
+from hashlib import sha256
+from io import BytesIO
+
+from discord import Attachment
+from sechat import Room
+from sechat.errors import OperationFailedError
+
+from bridget.util import TTLCache
+
+
+class AttachmentUploader:
+    # chat image URLs never change, so an attachment only ever needs uploading
+    # once, even when its message is edited or the same image is posted again
+    def __init__(self, memory_budget: int = 32 * 1024 * 1024, maxsize: int = 4096):
+        self.memory_budget = memory_budget
+        self.by_attachment: TTLCache[int, str] = TTLCache(maxsize)
+        self.by_hash: TTLCache[str, str] = TTLCache(maxsize)
+        self.uploads = 0
+        self._in_use = 0
+        self._released = Condition()
+
+    async def _reserve(self, size: int):
+        # an oversized attachment still gets through, just on its own
+        async with self._released:
+            await self._released.wait_for(lambda: self._in_use == 0 or self._in_use + size <= self.memory_budget)
+            self._in_use += size
+
+    async def _release(self, size: int):
+        async with self._released:
+            self._in_use -= size
+            self._released.notify_all()
+
+    async def _upload(self, room: Room, attachment: Attachment):
+        await self._reserve(attachment.size)
+        try:
+            data = await attachment.read()
+
+            async def upload(_: str):
+                self.uploads += 1
+                return await room.upload_image(BytesIO(data), attachment.filename)
+            return await self.by_hash.fetch(sha256(data).hexdigest(), upload)
+        finally:
+            await self._release(attachment.size)
+
+    async def upload(self, room: Room, attachment: Attachment):
+        try:
+            return await self.by_attachment.fetch(attachment.id, lambda _: self._upload(room, attachment))
+        except OperationFailedError:
+            return None
@@ -1,6 +1,15 @@
+from asyncio import Event, Semaphore, Task, TimeoutError, create_task, shield, sleep, wait_for
+from collections import OrderedDict
 from datetime import timedelta
-from urllib.parse import urlparse, urlunparse
-from aiohttp import ClientSession
+import json
+from logging import Logger, getLogger
+from time import monotonic, time
+from typing import Any, Awaitable, Callable, Generic, Hashable, TypeVar
+from urllib.parse import urlparse, urlsplit, urlunparse, urlunsplit
+
+from discord import Webhook
+
+from bridget.http import ChatHTTP
 
 STACK_IMGUR = "i.sstatic.net"
 
@@ -9,6 +18,9 @@ HOUR = MINUTE * 60
 DAY = HOUR * 24
 YEAR = DAY * 365 # I do like making assumptions
 
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
 def approximate_delta(delta: timedelta):
     def plural(n: int, suffix: str):
         if n == 1:
@@ -31,6 +43,64 @@ def pretty_delta(delta: timedelta):
         return "just now"
     return approximate_delta(delta) + " ago"
 
+def fix_chat_url(url: str):
+    # Screw with URLs to make them work outside of a browser
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    if not scheme:
+        scheme = "https"
+    if not netloc:
+        netloc = "chat.stackexchange.com"
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+# discord's error code for a webhook that's been deleted
+UNKNOWN_WEBHOOK = 10015
+
+def webhook_payload(webhook: Webhook) -> dict[str, Any]:
+    # enough to rebuild it with Webhook.from_state later, once given a token.
+    # tokens never go in the database: anyone who can read it could post as the
+    # webhook, and the token is always at hand anyway, from the config or from discord
+    payload: dict[str, Any] = {
+        "id": webhook.id,
+        "type": webhook.type.value,
+        "guild_id": webhook.guild_id,
+        "channel_id": webhook.channel_id,
+        "name": webhook.name,
+    }
+    if webhook.user is not None:
+        payload["user"] = {
+            "id": webhook.user.id,
+            "username": webhook.user.name,
+            "discriminator": webhook.user.discriminator,
+            "global_name": webhook.user.global_name,
+            "avatar": webhook.user.avatar.key if webhook.user.avatar is not None else None,
+        }
+    return payload
+
+async def flush_periodically(flush: Callable[[], Awaitable[None]], requested: Event, interval: float, logger: Logger, max_delay: float = 60):
+    # flush every `interval`, or sooner when asked to. a failed flush is retried
+    # with backoff instead of taking down everything running alongside it;
+    # only the last one on the way out gets to raise
+    failures = 0
+    try:
+        while True:
+            if failures:
+                await sleep(min(interval * 2 ** failures, max_delay))
+            else:
+                try:
+                    await wait_for(requested.wait(), interval)
+                except TimeoutError:
+                    pass
+            requested.clear()
+            try:
+                await flush()
+            except Exception:
+                failures += 1
+                logger.exception(f"Flush failed {failures} times in a row, retrying")
+            else:
+                failures = 0
+    finally:
+        await flush()
+
 def resolve_chat_pfp(pfp: str):
     if pfp.startswith("!"):
         pfp = pfp.removeprefix("!")
@@ -40,12 +110,108 @@ def resolve_chat_pfp(pfp: str):
         return pfp
     return f"https://www.gravatar.com/avatar/{pfp}?s=256&d=identicon&r=PG"
 
+class TTLCache(Generic[K, V]):
+    # bounded LRU, entries optionally expire after `ttl` seconds
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._pending: dict[K, Task[V]] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        # (key, value, age in seconds)
+        now = monotonic()
+        return [(key, value, now - stored_at) for key, (stored_at, value) in self._entries.items()]
+
+    def get(self, key: K) -> V | None:
+        if (entry := self._entries.get(key)) is not None:
+            stored_at, value = entry
+            if self.ttl is None or monotonic() - stored_at < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: K, value: V, age: float = 0):
+        if self.ttl is not None and age >= self.ttl:
+            return
+        self._entries[key] = (monotonic() - age, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: K) -> V | None:
+        if (entry := self._entries.pop(key, None)) is not None:
+            return entry[1]
+        return None
+
+    async def _fill(self, key: K, fetcher: Callable[[K], Awaitable[V]]):
+        try:
+            value = await fetcher(key)
+            self.put(key, value)
+            return value
+        finally:
+            del self._pending[key]
+
+    async def fetch(self, key: K, fetcher: Callable[[K], Awaitable[V]]) -> V:
+        # concurrent misses for the same key share a single fetch
+        if (value := self.get(key)) is not None:
+            return value
+        if (pending := self._pending.get(key)) is None:
+            pending = self._pending[key] = create_task(self._fill(key, fetcher))
+        return await shield(pending)
+
+class ChatProfileFetcher:
+    def __init__(self, http: ChatHTTP, maxsize: int = 1024, ttl: float = 5 * MINUTE, concurrency: int = 8):
+        self.http = http
+        self.profiles: TTLCache[int, dict] = TTLCache(maxsize, ttl)
+        self._semaphore = Semaphore(concurrency)
+
+    async def _fetch(self, user: int) -> dict:
+        async with self._semaphore:
+            return await self.http.get_json(f"/users/thumbs/{user}")
+
+    async def fetch_profile(self, user: int):
+        return await self.profiles.fetch(user, self._fetch)
+
 class ChatPFPFetcher:
-    def __init__(self):
-        self.pfp_cache = {}
+    def __init__(self, profiles: ChatProfileFetcher, cache_path: str | None = None, maxsize: int = 2048, ttl: float = DAY):
+        self.profiles = profiles
+        self.cache_path = cache_path
+        self.logger = getLogger("ChatPFPFetcher")
+        self.pfp_cache: TTLCache[int, str] = TTLCache(maxsize, ttl)
+
+    def load(self):
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path) as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Couldn't load avatar cache from {self.cache_path}: {e}")
+            return
+        now = time()
+        for user, (url, saved_at) in saved.items():
+            self.pfp_cache.put(int(user), url, age=now - saved_at)
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        now = time()
+        with open(self.cache_path, "w") as file:
+            json.dump({user: (url, now - age) for user, url, age in self.pfp_cache.items()}, file)
+
+    async def _fetch(self, user: int):
+        return resolve_chat_pfp((await self.profiles.fetch_profile(user))["email_hash"])
 
     async def fetch_pfp_url(self, user: int):
-        if user not in self.pfp_cache:
-            async with ClientSession() as session, session.get(f"https://chat.stackexchange.com/users/thumbs/{user}") as response:
-                self.pfp_cache[user] = resolve_chat_pfp((await response.json())["email_hash"])
-        return self.pfp_cache[user]
\ No newline at end of file
+        return await self.pfp_cache.fetch(user, self._fetch)